@@ -0,0 +1,319 @@
+"""
+Benchmarks for the OpenAPIPlugin request validation hot path.
+
+Each benchmark case drives a Bottle app with the plugin installed in process, through WebTest, and
+measures throughput, per request latency percentiles and memory allocated per request. Results are
+written as JSON so that runs from different commits can be compared:
+
+    python benchmarks/bench_plugin.py --output before.json
+    python benchmarks/bench_plugin.py --output after.json --compare before.json
+"""
+from itertools import product
+from time import perf_counter
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from bottle import Bottle, json_dumps, request, response
+from webtest import TestApp
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+import bottle_openapi_3  # noqa: E402
+from bottle_openapi_3 import OpenAPIPlugin, prebuild_spec  # noqa: E402
+
+
+QUICK_MATRIX = {
+    'paths': (10, 200),
+    'body_items': (1, 100),
+    'depth': (1, 4),
+    'validate': (True, False),
+    'auto_jsonify': (True, False),
+}
+
+FULL_MATRIX = {
+    'paths': (10, 100, 500, 2000),
+    'body_items': (1, 10, 100, 1000),
+    'depth': (1, 4, 8),
+    'validate': (True, False),
+    'auto_jsonify': (True, False),
+}
+
+DIMENSIONS = ('paths', 'body_items', 'depth', 'validate', 'auto_jsonify', 'response_items')
+
+# Routes answering with large responses are benchmarked separately (with fewer requests), on a small spec.
+LARGE_RESPONSE_CASE = {'paths': 10, 'body_items': 1, 'depth': 1}
+
+
+def nested_schema(depth):
+    schema = {
+        'type': 'object',
+        'required': ['name', 'count'],
+        'properties': {
+            'name': {'type': 'string', 'maxLength': 64},
+            'count': {'type': 'integer', 'minimum': 0},
+            'tags': {'type': 'array', 'items': {'type': 'string'}},
+        }
+    }
+    if depth > 1:
+        schema['properties']['child'] = nested_schema(depth - 1)
+    return schema
+
+
+def nested_document(depth):
+    document = {'name': 'item', 'count': depth, 'tags': ['a', 'b']}
+    if depth > 1:
+        document['child'] = nested_document(depth - 1)
+    return document
+
+
+def build_openapi_def(paths, depth):
+    """
+    A specification with the given number of paths, each with a get and a post operation whose
+    request and response bodies are arrays of objects nested depth levels deep.
+    """
+    body_schema = {
+        'type': 'object',
+        'required': ['items'],
+        'properties': {'items': {'type': 'array', 'items': {'$ref': '#/components/schemas/Item'}}}
+    }
+    content = {'application/json': {'schema': {'$ref': '#/components/schemas/Body'}}}
+    spec_paths = {}
+    for i in range(paths):
+        spec_paths['/resources{0}/{{resource_id}}'.format(i)] = {
+            'parameters': [
+                {'name': 'resource_id', 'in': 'path', 'required': True, 'schema': {'type': 'integer'}}
+            ],
+            'get': {
+                'operationId': 'getResource{0}'.format(i),
+                'parameters': [{'name': 'limit', 'in': 'query', 'schema': {'type': 'integer'}}],
+                'responses': {'200': {'description': 'The resource', 'content': content}}
+            },
+            'post': {
+                'operationId': 'updateResource{0}'.format(i),
+                'requestBody': {'required': True, 'content': content},
+                'responses': {'200': {'description': 'The updated resource', 'content': content}}
+            }
+        }
+    return {
+        'openapi': '3.0.0',
+        'info': {'title': 'Benchmark API', 'version': '1.0.0'},
+        'servers': [{'url': '/'}],
+        'paths': spec_paths,
+        'components': {'schemas': {'Item': nested_schema(depth), 'Body': body_schema}}
+    }
+
+
+def build_app(openapi_def, paths, validate, auto_jsonify, response_items=0):
+    app = Bottle()
+    app.install(OpenAPIPlugin(
+        openapi_def,
+        validate_requests=validate,
+        validate_responses=validate,
+        auto_jsonify=auto_jsonify,
+        serve_openapi_schema=False
+    ))
+    # Requests go to the operation in the middle of the spec, so that the spec's size matters.
+    target = paths // 2
+
+    def update_resource(resource_id):
+        body = request.json
+        if response_items:
+            # Answer with many copies of the first item, rather than echoing the body back.
+            body = {'items': body['items'][:1] * response_items}
+        if auto_jsonify:
+            return body
+        response.content_type = 'application/json'
+        return json_dumps(body)
+    app.route('/resources{0}/<resource_id:int>'.format(target), method='POST', callback=update_resource)
+    return TestApp(app), '/resources{0}/1'.format(target)
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_case(openapi_def, case, requests, warmup, allocation_requests):
+    test_app, url = build_app(
+        openapi_def, case['paths'], case['validate'], case['auto_jsonify'], response_items=case['response_items']
+    )
+    body = json_dumps({'items': [nested_document(case['depth'])] * case['body_items']}).encode('utf-8')
+
+    def one_request():
+        test_app.post(url, params=body, content_type='application/json', status=200)
+
+    for _ in range(warmup):
+        one_request()
+
+    latencies = []
+    started = perf_counter()
+    for _ in range(requests):
+        request_started = perf_counter()
+        one_request()
+        latencies.append(perf_counter() - request_started)
+    elapsed = perf_counter() - started
+
+    # Allocations are measured separately, since tracing them slows everything else down. Tracing is
+    # restarted for each request, which resets the peak (tracemalloc.reset_peak needs Python 3.9).
+    peaks = []
+    allocated = []
+    for _ in range(allocation_requests):
+        blocks_before = sys.getallocatedblocks()
+        tracemalloc.start()
+        try:
+            one_request()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        peaks.append(peak)
+        allocated.append(sys.getallocatedblocks() - blocks_before)
+
+    latencies.sort()
+    result = dict(case)
+    result.update(
+        request_bytes=len(body),
+        requests=requests,
+        requests_per_second=requests / elapsed,
+        latency_ms={
+            'mean': 1000.0 * elapsed / requests,
+            'p50': 1000.0 * percentile(latencies, 0.50),
+            'p90': 1000.0 * percentile(latencies, 0.90),
+            'p99': 1000.0 * percentile(latencies, 0.99),
+            'max': 1000.0 * latencies[-1],
+        },
+        peak_allocated_kib=max(peaks) / 1024.0 if peaks else None,
+        retained_blocks_per_request=sum(allocated) / len(allocated) if allocated else None,
+    )
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def case_key(result):
+    # Results from before response_items was a dimension only had cases that echoed the body back.
+    return tuple(result.get(dimension, 0) for dimension in DIMENSIONS)
+
+
+def format_case(result):
+    return ' '.join('{0}={1}'.format(dimension, result[dimension]) for dimension in DIMENSIONS)
+
+
+def print_result(result):
+    print('{0:<86} {1:>9.1f} req/s  p50 {2:.2f}ms  p99 {3:.2f}ms  peak {4:.1f}KiB'.format(
+        format_case(result), result['requests_per_second'], result['latency_ms']['p50'],
+        result['latency_ms']['p99'], result['peak_allocated_kib'] or 0.0
+    ))
+
+
+def compare(results, baseline, threshold):
+    """
+    Print how each case compares with the same case in a baseline run, returning the number of
+    cases whose throughput regressed by more than threshold percent.
+    """
+    baseline_results = {case_key(result): result for result in baseline['results']}
+    regressions = 0
+    print('\nCompared with {0}:'.format(baseline.get('revision') or 'baseline'))
+    for result in results:
+        previous = baseline_results.get(case_key(result))
+        if previous is None:
+            continue
+        change = 100.0 * (result['requests_per_second'] / previous['requests_per_second'] - 1.0)
+        regressed = change < -threshold
+        regressions += regressed
+        print('{0:<86} {1:>+8.1f}% req/s  p99 {2:.2f}ms -> {3:.2f}ms{4}'.format(
+            format_case(result), change, previous['latency_ms']['p99'], result['latency_ms']['p99'],
+            '  REGRESSION' if regressed else ''
+        ))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--full', action='store_true', help='Run the full matrix rather than the quick one.')
+    for dimension in DIMENSIONS[:3]:
+        parser.add_argument('--' + dimension.replace('_', '-'), type=int, nargs='+',
+                            help='Override the {0} values to benchmark.'.format(dimension))
+    parser.add_argument('--response-items', type=int, nargs='*', default=[5000],
+                        help='Response sizes (in items) to benchmark routes answering with large responses at.')
+    parser.add_argument('--response-requests', type=int, default=5,
+                        help='Timed requests per large response case.')
+    parser.add_argument('--requests', type=int, default=200, help='Timed requests per case.')
+    parser.add_argument('--warmup', type=int, default=20, help='Untimed requests per case before timing.')
+    parser.add_argument('--allocation-requests', type=int, default=10,
+                        help='Requests per case to trace allocations for.')
+    parser.add_argument('--output', help='Write the results as JSON to this file.')
+    parser.add_argument('--compare', help='A previous JSON results file to compare these results with.')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='The throughput drop, in percent, that counts as a regression.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    matrix = dict(FULL_MATRIX if args.full else QUICK_MATRIX)
+    for dimension in DIMENSIONS[:3]:
+        if getattr(args, dimension):
+            matrix[dimension] = tuple(getattr(args, dimension))
+
+    results = []
+    spec_build_seconds = {}
+    for paths, depth in product(matrix['paths'], matrix['depth']):
+        openapi_def = build_openapi_def(paths, depth)
+        started = perf_counter()
+        # Every case for this spec then reuses the one build.
+        prebuild_spec(openapi_def)
+        spec_build_seconds['paths={0} depth={1}'.format(paths, depth)] = perf_counter() - started
+        for body_items, validate, auto_jsonify in product(
+                matrix['body_items'], matrix['validate'], matrix['auto_jsonify']):
+            case = dict(paths=paths, body_items=body_items, depth=depth, validate=validate, auto_jsonify=auto_jsonify,
+                        response_items=0)
+            result = run_case(openapi_def, case, args.requests, args.warmup, args.allocation_requests)
+            results.append(result)
+            print_result(result)
+
+    if args.response_items:
+        openapi_def = build_openapi_def(LARGE_RESPONSE_CASE['paths'], LARGE_RESPONSE_CASE['depth'])
+        prebuild_spec(openapi_def)
+        for response_items, validate, auto_jsonify in product(args.response_items, (True, False), (True, False)):
+            case = dict(LARGE_RESPONSE_CASE, validate=validate, auto_jsonify=auto_jsonify, response_items=response_items)
+            result = run_case(openapi_def, case, args.response_requests, 1, 1)
+            results.append(result)
+            print_result(result)
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'bottle_openapi_3': bottle_openapi_3.__version__,
+        'spec_build_seconds': spec_build_seconds,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
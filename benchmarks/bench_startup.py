@@ -0,0 +1,161 @@
+"""
+Benchmarks for how long a process takes to start serving requests with the OpenAPIPlugin.
+
+Each case runs in a fresh interpreter, and measures how long importing bottle_openapi_3 takes, how
+long creating the plugin and installing it in an app takes, and how long the first request to an API
+route takes after that, with the spec built up front and with its build deferred. Results are
+written as JSON so that runs from different commits can be compared:
+
+    python benchmarks/bench_startup.py --output before.json
+    python benchmarks/bench_startup.py --output after.json --compare before.json
+"""
+from itertools import product
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from bench_plugin import build_openapi_def, git_revision, nested_document
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+DIMENSIONS = ('paths', 'defer')
+
+PHASES = ('import', 'setup', 'first_request', 'total')
+
+# Run in a fresh interpreter for each sample, with the spec as JSON on stdin; prints the timings.
+CHILD = """
+from time import perf_counter
+import json
+import sys
+
+started = perf_counter()
+import bottle_openapi_3
+imported = perf_counter()
+
+from bottle import Bottle, request
+from webtest import TestApp
+
+options = json.load(sys.stdin)
+app = Bottle()
+app.install(bottle_openapi_3.OpenAPIPlugin(
+    options['openapi_def'], defer_spec_build=options['defer'], serve_openapi_schema=False
+))
+app.route(options['rule'], method='POST', callback=lambda resource_id: request.json)
+test_app = TestApp(app)
+set_up = perf_counter()
+
+test_app.post(options['url'], params=json.dumps(options['body']), content_type='application/json', status=200)
+first_request = perf_counter()
+
+print(json.dumps({
+    'import': imported - started,
+    'setup': set_up - imported,
+    'first_request': first_request - set_up,
+    'total': first_request - started,
+}))
+"""
+
+
+def run_sample(options):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])))
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD], input=json.dumps(options).encode('utf-8'),
+        stdout=subprocess.PIPE, env=env, check=True
+    ).stdout
+    return json.loads(output.decode('utf-8'))
+
+
+def run_case(case, samples):
+    target = case['paths'] // 2
+    options = {
+        'openapi_def': build_openapi_def(case['paths'], 2),
+        'defer': case['defer'],
+        'rule': '/resources{0}/<resource_id:int>'.format(target),
+        'url': '/resources{0}/1'.format(target),
+        'body': {'items': [nested_document(2)]},
+    }
+    timings = [run_sample(options) for _ in range(samples)]
+    result = dict(case)
+    result.update(
+        samples=samples,
+        median_ms={phase: 1000.0 * statistics.median(timing[phase] for timing in timings) for phase in PHASES},
+    )
+    return result
+
+
+def case_key(result):
+    return tuple(result[dimension] for dimension in DIMENSIONS)
+
+
+def format_case(result):
+    return ' '.join('{0}={1}'.format(dimension, result[dimension]) for dimension in DIMENSIONS)
+
+
+def compare(results, baseline, threshold):
+    """
+    Print how each case compares with the same case in a baseline run, returning the number of
+    cases whose time to first request grew by more than threshold percent.
+    """
+    baseline_results = {case_key(result): result for result in baseline['results']}
+    regressions = 0
+    print('\nCompared with {0}:'.format(baseline.get('revision') or 'baseline'))
+    for result in results:
+        previous = baseline_results.get(case_key(result))
+        if previous is None:
+            continue
+        change = 100.0 * (result['median_ms']['total'] / previous['median_ms']['total'] - 1.0)
+        regressed = change > threshold
+        regressions += regressed
+        print('{0:<30} total {1:>+8.1f}%  import {2:.1f}ms -> {3:.1f}ms{4}'.format(
+            format_case(result), change, previous['median_ms']['import'], result['median_ms']['import'],
+            '  REGRESSION' if regressed else ''
+        ))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--paths', type=int, nargs='+', default=[10, 500], help='The spec sizes to benchmark.')
+    parser.add_argument('--samples', type=int, default=5, help='Fresh processes to time per case.')
+    parser.add_argument('--output', help='Write the results as JSON to this file.')
+    parser.add_argument('--compare', help='A previous JSON results file to compare these results with.')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='The growth in time to first request, in percent, that counts as a regression.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = []
+    for paths, defer in product(args.paths, (False, True)):
+        result = run_case(dict(paths=paths, defer=defer), args.samples)
+        results.append(result)
+        print('{0:<30} import {import:.1f}ms  setup {setup:.1f}ms  first request {first_request:.1f}ms  '
+              'total {total:.1f}ms'.format(format_case(result), **result['median_ms']))
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,43 +1,111 @@
 __version__ = (0, 1, 0)
 __author__ = "Robert Cope (Cope Systems)"
 
-from bottle import Request, Response, json_dumps, SimpleTemplate, static_file, request, response, HTTPResponse
-from openapi_core.validation.request.datatypes import OpenAPIRequest, RequestParameters, RequestValidationResult
-from openapi_core.validation.request.validators import RequestValidator
-from openapi_core.validation.response.datatypes import OpenAPIResponse, ResponseValidationResult
-from openapi_core.validation.response.validators import ResponseValidator
-from openapi_core.validation.exceptions import InvalidSecurity
-from openapi_core.schema.media_types.exceptions import InvalidContentType
-from openapi_core.templating.paths.exceptions import OperationNotFound, PathNotFound
-from openapi_core import create_spec
-from openapi_spec_validator import validate_spec
+from bottle import Request, Response, json_dumps, SimpleTemplate, request, response, HTTPResponse
 from six.moves.urllib.parse import urljoin, urlparse
-from functools import wraps
+from .caching import REVALIDATE_CACHE_CONTROL, CachedPayload, StaticAssetTable
+from .datatypes import NOT_PARSED, BottleOpenAPIRequest, BottleOpenAPIResponse, BottleRequestParameters, \
+    LazyRequestMapping
+from .metrics import HANDLER, REQUEST_CONVERSION, REQUEST_VALIDATION, RESPONSE_VALIDATION, SERIALIZATION, \
+    MetricsCollector, PhaseTimer
+from .registry import SpecRegistry, default_spec_registry
+from .shadow import ShadowValidationPool, default_shadow_response_error_handler
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
+from typing import TYPE_CHECKING
 import logging
+import random
 import re
+import threading
+import weakref
 import os
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# openapi-core (along with openapi-spec-validator and jsonschema) takes a while to import, so it's only
+# imported once a spec is actually built, or a request fails validation; the .specs and .validators
+# modules are imported lazily for the same reason, so what they define has to be imported from them.
+if TYPE_CHECKING:
+    from openapi_core.validation.request.datatypes import OpenAPIRequest, RequestValidationResult
+    from openapi_core.validation.response.datatypes import OpenAPIResponse, ResponseValidationResult
+
+__all__ = [
+    'OpenAPIPlugin', 'prebuild_spec', 'fast_json_dumps', 'default_request_error_handler',
+    'default_response_error_handler', 'default_server_error_handler', 'default_shadow_response_error_handler',
+    'MetricsCollector', 'ShadowValidationPool', 'SpecRegistry', 'default_spec_registry',
+    'BOTTLE_PATH_PARAMETER_REGEX', 'SWAGGER_UI_VERSION', 'ROUTE_CONFIG_PREFIX', 'ROUTE_CONFIG_KEYS',
+    'SWAGGER_UI_DIR', 'SWAGGER_UI_INDEX_TEMPLATE_PATH', 'SWAGGER_UI_UNVERSIONED_ASSETS',
+]
 
 openapi_3_plugin_logger = logging.getLogger(__name__)
 
 BOTTLE_PATH_PARAMETER_REGEX = re.compile(r'/<(.+?)(:.+)?>')
 
+SWAGGER_UI_VERSION = '3.38.0'
+
+# Routes can override plugin settings with these keys in their config, e.g. openapi3.validate_responses.
+ROUTE_CONFIG_PREFIX = 'openapi3.'
+ROUTE_CONFIG_KEYS = frozenset(('validate_requests', 'validate_responses', 'auto_jsonify', 'sample_rate', 'max_body'))
 SWAGGER_UI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
-        'vendor', 'swagger-ui-3.38.0-dist')
+        'vendor', 'swagger-ui-{0}-dist'.format(SWAGGER_UI_VERSION))
 SWAGGER_UI_INDEX_TEMPLATE_PATH = os.path.join(SWAGGER_UI_DIR, 'index.html.st')
+# Swagger UI assets that aren't linked to with the Swagger UI version in their URL, so mustn't be cached for good.
+SWAGGER_UI_UNVERSIONED_ASSETS = ('index.html', 'index.html.st', 'oauth2-redirect.html')
+
 
-with open(SWAGGER_UI_INDEX_TEMPLATE_PATH, 'r') as f:
-    SWAGGER_UI_INDEX_TEMPLATE = f.read()
+def fast_json_dumps(obj):
+    """
+    Serialize an object to JSON with orjson if it's installed, falling back to Bottle's JSON encoder.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json_dumps(obj)
 
 
 def _get_mimetype(content_type: str) -> str:
     return content_type.partition(";")[0]
 
 
+@lru_cache(maxsize=None)
+def _swagger_ui_index_template():
+    # Only read when the Swagger UI is first served.
+    with open(SWAGGER_UI_INDEX_TEMPLATE_PATH, 'r') as f:
+        return SimpleTemplate(f.read())
+
+
+def prebuild_spec(openapi_def, validate=True, cache_dir=None):
+    """
+    Build a spec in this process ahead of time so that every OpenAPIPlugin created for the same
+    specification later on reuses it. See bottle_openapi_3.specs.prebuild_spec.
+    """
+    from .specs import prebuild_spec
+    return prebuild_spec(openapi_def, validate=validate, cache_dir=cache_dir)
+
+
+@lru_cache(maxsize=None)
+def _swagger_ui_assets():
+    return StaticAssetTable(SWAGGER_UI_DIR, cache_controls={
+        path: REVALIDATE_CACHE_CONTROL for path in SWAGGER_UI_UNVERSIONED_ASSETS
+    })
+
+
 def _render_index_html(spec_url, validator_url=None):
-    return SimpleTemplate(SWAGGER_UI_INDEX_TEMPLATE).render(
+    return _swagger_ui_index_template().render(
         spec_url=spec_url,
-        validator_url=json_dumps(validator_url)
+        validator_url=json_dumps(validator_url),
+        swagger_ui_version=SWAGGER_UI_VERSION
+    )
+
+
+@lru_cache(maxsize=64)
+def _swagger_ui_index_payload(spec_url, validator_url=None):
+    return CachedPayload(
+        _render_index_html(spec_url, validator_url=validator_url).encode("utf-8"),
+        "text/html; charset=UTF-8",
+        cache_control=REVALIDATE_CACHE_CONTROL
     )
 
 
@@ -57,37 +125,221 @@ def _validation_error_response(status, payload):
     }
 
 
-def _generate_request_parameters(req: Request) -> RequestParameters:
-    return RequestParameters(
+def _generate_request_parameters(req: Request) -> BottleRequestParameters:
+    # Nothing is copied, and the query and cookies are only parsed if the operation looks in them.
+    return BottleRequestParameters(
         path=req.url_args,
-        query=req.query,
-        header=dict(req.headers),
-        cookie=dict(req.cookies)
+        query=LazyRequestMapping(req.environ, 'query'),
+        header=req.headers,
+        cookie=LazyRequestMapping(req.environ, 'cookies')
     )
 
 
-def _bottle_request_to_openapi_request(req: Request) -> OpenAPIRequest:
-    # TODO: The default JSON deserializer for the OpenAPI toolkit does not handle
-    # bytes I/O or streams, it looks like it requires strings. Can we bolt in an
-    # alternate deserializer to make this work better?
-    return OpenAPIRequest(
-        full_url_pattern=BOTTLE_PATH_PARAMETER_REGEX.sub(r'/{\1}', req.route.rule),
+def _bottle_rule_to_openapi_path(rule: str) -> str:
+    return BOTTLE_PATH_PARAMETER_REGEX.sub(r'/{\1}', rule)
+
+
+def _request_body_size(req: Request) -> int:
+    if req.content_length >= 0:
+        return req.content_length
+    # Chunked bodies have no declared length, but Bottle has spooled them (to disk, if they're large) by now.
+    body = req.body
+    body.seek(0, os.SEEK_END)
+    size = body.tell()
+    body.seek(0)
+    return size
+
+
+def _response_body_size(resp: Response) -> int:
+    body = resp.body
+    return len(body) if isinstance(body, (bytes, str)) else 0
+
+
+def _can_stream_request_body(req: Request, indexed_operation) -> bool:
+    if indexed_operation is None or indexed_operation.request_body is None:
+        return False
+    from openapi_core.schema.media_types.exceptions import InvalidContentType
+    from .validators import is_streamable_media_type
+    try:
+        media_type = indexed_operation.request_body[_get_mimetype(req.content_type)]
+    except InvalidContentType:
+        return False
+    return is_streamable_media_type(media_type)
+
+
+def _bottle_request_to_openapi_request(req: Request, full_url_pattern=None,
+                                       indexed_operation=None, stream_body=False) -> 'OpenAPIRequest':
+    # The body is handed over as bytes; the JSON deserializer the validators use parses bytes directly.
+    if full_url_pattern is None:
+        full_url_pattern = _bottle_rule_to_openapi_path(req.route.rule)
+    return BottleOpenAPIRequest(
+        full_url_pattern=full_url_pattern,
         method=req.method.lower(),
         parameters=_generate_request_parameters(req),
-        body=req.body.read(),
-        mimetype=_get_mimetype(req.content_type)
+        body=None if stream_body else req.body.read(),
+        mimetype=_get_mimetype(req.content_type),
+        indexed_operation=indexed_operation,
+        body_stream=req.body if stream_body else None
     )
 
 
-def _bottle_response_to_openapi_response(resp: Response) -> OpenAPIResponse:
-    return OpenAPIResponse(
+def _share_request_validation_result(req: Request, openapi_request: 'OpenAPIRequest',
+                                     request_validation_result: 'RequestValidationResult'):
+    """
+    Hand what request validation already parsed over to the route handler, so it doesn't
+    have to parse any of it again.
+    """
+    if request_validation_result is None:
+        req.openapi_body = None
+        req.openapi_params = None
+        return
+    req.openapi_body = request_validation_result.body
+    req.openapi_params = request_validation_result.parameters
+    parsed_body = getattr(openapi_request, 'parsed_body', NOT_PARSED)
+    if parsed_body is not NOT_PARSED and openapi_request.mimetype == 'application/json':
+        # Bottle caches request.json in the environ, so prime it with the body we already parsed.
+        req.environ['bottle.request.json'] = parsed_body
+
+
+def _bottle_response_to_openapi_response(resp: Response) -> 'OpenAPIResponse':
+    return BottleOpenAPIResponse(
         data=resp.body,
         status_code=resp.status_code,
         mimetype=_get_mimetype(resp.content_type)
     )
 
 
-def default_request_error_handler(req: Request, request_validation_result: RequestValidationResult):
+_CONFIG_FLAG_STRINGS = {
+    'true': True, 'yes': True, 'on': True, '1': True,
+    'false': False, 'no': False, 'off': False, '0': False,
+}
+
+
+def _config_flag(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    elif isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    elif isinstance(value, str) and value.strip().lower() in _CONFIG_FLAG_STRINGS:
+        return _CONFIG_FLAG_STRINGS[value.strip().lower()]
+    raise ValueError("expected a boolean, got {0!r}".format(value))
+
+
+def _config_sample_rate(value) -> float:
+    if isinstance(value, bool):
+        raise ValueError("expected a number from 0.0 to 1.0, got {0!r}".format(value))
+    rate = float(value)
+    if not 0.0 <= rate <= 1.0:
+        raise ValueError("expected a number from 0.0 to 1.0, got {0!r}".format(value))
+    return rate
+
+
+def _config_body_size(value) -> int:
+    if isinstance(value, (bool, float)):
+        raise ValueError("expected a whole number of bytes, got {0!r}".format(value))
+    size = int(value)
+    if size < 0:
+        raise ValueError("expected a whole number of bytes, got {0!r}".format(value))
+    return size
+
+
+# How the value of each route config key is converted (and checked) when the plugin is applied to the route.
+_ROUTE_CONFIG_CONVERTERS = {
+    'validate_requests': _config_flag,
+    'validate_responses': _config_flag,
+    'auto_jsonify': _config_flag,
+    'sample_rate': _config_sample_rate,
+    'max_body': _config_body_size,
+}
+
+
+def _sampled(rate) -> bool:
+    if rate >= 1.0:
+        return True
+    elif rate <= 0.0:
+        return False
+    return random.random() < rate
+
+
+def _default_base_path(openapi_def) -> str:
+    """
+    The path of the first server in a specification, with its variables at their defaults, worked out
+    from the specification dictionary itself so that the spec doesn't have to be built first.
+    """
+    servers = openapi_def.get('servers') or [{'url': '/'}]
+    server = servers[0]
+    variables = {name: variable.get('default') for name, variable in (server.get('variables') or {}).items()}
+    return urlparse(server['url'].format(**variables)).path or '/'
+
+
+class _SpecVersion(object):
+    """
+    An OpenAPI specification along with everything built from it to validate requests and responses.
+    Reloading the plugin swaps in a whole new version at once, so a request that started against one
+    version finishes against it.
+    """
+
+    def __init__(self, openapi_def, openapi_spec, request_validation_cache_size=None):
+        from .validators import IndexedRequestValidator, IndexedResponseValidator, OperationIndex, \
+            RequestValidationCache
+        self.openapi_def = openapi_def
+        self.openapi_spec = openapi_spec
+        self.operation_index = OperationIndex(openapi_spec)
+        if request_validation_cache_size:
+            self.request_validation_cache = RequestValidationCache(openapi_spec, maxsize=request_validation_cache_size)
+        else:
+            self.request_validation_cache = None
+        self.request_validator = IndexedRequestValidator(openapi_spec, result_cache=self.request_validation_cache)
+        self.response_validator = IndexedResponseValidator(openapi_spec)
+        self.openapi_schema_payloads = {}
+
+
+class _OperationPlan(object):
+    """
+    Everything about validating requests to a route with a particular method against a particular
+    spec version, worked out once rather than on every request.
+    """
+
+    def __init__(self, route_plan, spec_version, indexed_operation, max_request_body_size=None,
+                 response_validation_sample_rate=1.0, operation_key=None):
+        self.spec_version = spec_version
+        self.full_url_pattern = route_plan.full_url_pattern
+        self.validate_requests = route_plan.validate_requests
+        self.validate_responses = route_plan.validate_responses
+        self.auto_jsonify = route_plan.auto_jsonify
+        self.indexed_operation = indexed_operation
+        self.max_request_body_size = max_request_body_size
+        self.response_validation_sample_rate = response_validation_sample_rate
+        self.operation_key = operation_key
+
+
+class _RoutePlan(object):
+    """
+    Everything about validating a single Bottle route that only depends on the route itself,
+    worked out once when the plugin is applied to the route rather than on every request.
+    """
+
+    def __init__(self, rule, method, full_url_pattern, validate_requests=True, validate_responses=True,
+                 auto_jsonify=True, response_validation_sample_rate=None, max_request_body_size=None):
+        self.rule = rule
+        self.method = method
+        self.full_url_pattern = full_url_pattern
+        self.validate_requests = validate_requests
+        self.validate_responses = validate_responses
+        self.auto_jsonify = auto_jsonify
+        # Overrides of the spec and plugin wide settings for this route, if it has any.
+        self.response_validation_sample_rate = response_validation_sample_rate
+        self.max_request_body_size = max_request_body_size
+        # The spec version the operation plans were made for, and the plans by request method. Both are
+        # replaced together, so a plan is never handed out for a different version than it was made for.
+        self.operation_plans = (None, {})
+
+
+def default_request_error_handler(req: Request, request_validation_result: 'RequestValidationResult'):
+    from openapi_core.schema.media_types.exceptions import InvalidContentType
+    from openapi_core.templating.paths.exceptions import OperationNotFound, PathNotFound
+    from openapi_core.validation.exceptions import InvalidSecurity
+    from .validators import RequestBodyTooLarge
     assert request_validation_result.errors, "Should have errors associated with the request validation."
     status = 400
     for error in request_validation_result.errors:
@@ -99,6 +351,8 @@ def default_request_error_handler(req: Request, request_validation_result: Reque
             status = 404
         if isinstance(error, InvalidContentType):
             status = 415
+        if isinstance(error, RequestBodyTooLarge):
+            status = 413
     openapi_3_plugin_logger.warning(
         "Request validation failure. Request: {0} Validation Result: {1}"
         "".format(req, request_validation_result)
@@ -106,7 +360,8 @@ def default_request_error_handler(req: Request, request_validation_result: Reque
     return _validation_error_response(status, [str(e) for e in request_validation_result.errors])
 
 
-def default_response_error_handler(req: Request, resp: Response, response_validation_result: ResponseValidationResult):
+def default_response_error_handler(req: Request, resp: Response,
+                                   response_validation_result: 'ResponseValidationResult'):
     assert response_validation_result.errors, "Should have errors associated with the request validation."
     openapi_3_plugin_logger.error(
         "Response validation failure handling route! Request: {0}, Result: {1}"
@@ -123,6 +378,8 @@ def default_server_error_handler(req: Request, e: Exception):
 class OpenAPIPlugin(object):
     DEFAULT_SWAGGER_SCHEMA_SUBURL = '/openapi.json'
     DEFAULT_SWAGGER_UI_SUBURL = '/ui/'
+    DEFAULT_STATS_SUBURL = '/openapi-stats.json'
+    MAX_OPENAPI_SCHEMA_VARIANTS = 32
 
     name = 'openapi3'
     api = 2
@@ -132,6 +389,12 @@ class OpenAPIPlugin(object):
                  validate_requests=True,
                  validate_responses=True,
                  auto_jsonify=True,
+                 json_encoder=json_dumps,
+                 max_request_body_size=None,
+                 stream_request_body_threshold=None,
+                 request_validation_cache_size=None,
+                 offload_validation_threshold=None,
+                 validation_executor=None,
                  request_error_handler=default_request_error_handler,
                  response_error_handler=default_response_error_handler,
                  exception_handler=default_server_error_handler,
@@ -144,7 +407,21 @@ class OpenAPIPlugin(object):
                  swagger_ui_schema_url=None,
                  swagger_ui_suburl=DEFAULT_SWAGGER_UI_SUBURL,
                  swagger_ui_route_name=None,
-                 swagger_ui_validator_url=None):
+                 swagger_ui_validator_url=None,
+                 spec_cache_dir=None,
+                 response_validation_sample_rate=1.0,
+                 response_validation_sample_rates=None,
+                 shadow_response_validation=False,
+                 shadow_response_error_handler=default_shadow_response_error_handler,
+                 shadow_validation_workers=1,
+                 shadow_validation_queue_size=1000,
+                 collect_metrics=False,
+                 metrics_sink=None,
+                 serve_stats=False,
+                 stats_suburl=DEFAULT_STATS_SUBURL,
+                 stats_route_name=None,
+                 defer_spec_build=False,
+                 spec_registry=None):
         """
         Create a new OpenAPI plugin for doing server-side validation in Bottle.
 
@@ -159,6 +436,30 @@ class OpenAPIPlugin(object):
         :param auto_jsonify: Should we automatically convert API responses from the results of the
             bottle routes into JSON?
         :type auto_jsonify: bool
+        :param json_encoder: The callable used to serialize route results to JSON when auto_jsonify is on.
+            Results are only encoded once, and responses are validated as encoded.
+            Use fast_json_dumps to encode with orjson when it is available.
+        :type json_encoder: Callable
+        :param max_request_body_size: The largest request body, in bytes, that API routes will accept. Larger
+            bodies are rejected with a 413 before they are read. Operations can set their own limit with the
+            x-max-request-body-size extension.
+        :type max_request_body_size: Optional[int]
+        :param stream_request_body_threshold: Request bodies larger than this many bytes that are JSON arrays
+            are validated item by item as they are parsed, rather than being read and parsed all at once.
+            These bodies are not available as request.openapi_body; handlers should read request.body instead.
+        :type stream_request_body_threshold: Optional[int]
+        :param request_validation_cache_size: The number of request validation results to keep in an LRU cache,
+            for requests without a body to operations without security requirements. Results are keyed on the
+            values of the parameters the operation declares, so repeated requests skip validation. Off if None.
+        :type request_validation_cache_size: Optional[int]
+        :param offload_validation_threshold: Request and response bodies of at least this many bytes are
+            validated on the validation_executor, with the request waiting for the result, rather than on the
+            thread (or greenlet) handling the request. Smaller bodies are always validated in place.
+        :type offload_validation_threshold: Optional[int]
+        :param validation_executor: The concurrent.futures executor to offload validation to. Under gevent,
+            use gevent.threadpool.ThreadPoolExecutor so validation runs on real threads and the hub stays free.
+            Defaults to a ThreadPoolExecutor that is created the first time it's needed.
+        :type validation_executor: Optional[concurrent.futures.Executor]
         :param request_error_handler: An arity 2 callable that gets invoked when there is an
             error validating the request.
         :type request_error_handler: Callable
@@ -189,19 +490,89 @@ class OpenAPIPlugin(object):
         :param swagger_ui_route_name: The bottle route name for the base page of the embedded Swagger UI.
         :type swagger_ui_route_name: Optional[str]
         :param swagger_ui_validator_url: The URL to a Swagger validator to use in the UI.
+        :param spec_cache_dir: A directory to cache validated and built specs in, so that processes starting up
+            with a specification that has been seen before can skip validating and building it. Cached specs are
+            pickled, so this directory must only be writable by the application. See also prebuild_spec.
+        :type spec_cache_dir: Optional[str]
+        :param response_validation_sample_rate: The fraction (0.0 to 1.0) of responses to validate, when
+            validate_responses is on.
+        :type response_validation_sample_rate: float
+        :param response_validation_sample_rates: Per operation response validation sample rates, by operationId,
+            which take precedence over response_validation_sample_rate.
+        :type response_validation_sample_rates: Optional[Dict[str, float]]
+        :param shadow_response_validation: Should responses be sent back to the client right away and validated
+            afterwards on background threads? Validation failures are then reported to the
+            shadow_response_error_handler instead of changing the response.
+        :type shadow_response_validation: bool
+        :param shadow_response_error_handler: An arity 3 callable that gets invoked with the OpenAPI request,
+            OpenAPI response and validation result when shadow response validation fails.
+        :type shadow_response_error_handler: Callable
+        :param shadow_validation_workers: The number of background threads used for shadow response validation.
+        :type shadow_validation_workers: int
+        :param shadow_validation_queue_size: How many responses can be waiting for shadow validation before
+            further responses are dropped (without being validated) instead.
+        :type shadow_validation_queue_size: int
+        :param collect_metrics: Should we keep per operation timings of each phase of handling API requests, and
+            counts of validation errors by class, in process? See metrics_collector.snapshot().
+        :type collect_metrics: bool
+        :param metrics_sink: An arity 3 callable that gets invoked after every API request with the operation (its
+            operationId, or method and path), a dictionary of phase names to durations in seconds, and a list of
+            the class names of any validation errors.
+        :type metrics_sink: Optional[Callable]
+        :param serve_stats: Should we serve the collected metrics as JSON? Implies collect_metrics.
+        :type serve_stats: bool
+        :param stats_suburl: The suburl path used to serve the collected metrics.
+        :type stats_suburl: str
+        :param stats_route_name: The bottle route name for the collected metrics.
+        :type stats_route_name: Optional[str]
+        :param defer_spec_build: Should validating and building the specification, and the validators, be put
+            off until the first API request (or a call to warmup), rather than done when the plugin is created?
+        :type defer_spec_build: bool
+        :param spec_registry: A registry to share the built spec, validators and compiled schemas through, with
+            every other plugin using the same registry for the same specification. Pass default_spec_registry to
+            share them process wide.
+        :type spec_registry: Optional[SpecRegistry]
         """
-        self.openapi_def = dict(openapi_def)
-        if openapi_base_path is not None:
-            self.openapi_def.update(basePath=openapi_base_path)
-
-        if validate_openapi_spec:
-            validate_spec(self.openapi_def)
-        self.openapi_spec = create_spec(self.openapi_def)
-        self.request_validator = RequestValidator(self.openapi_spec)
-        self.response_validator = ResponseValidator(self.openapi_spec)
+        self.validate_openapi_spec = validate_openapi_spec
+        self.spec_cache_dir = spec_cache_dir
+        self.request_validation_cache_size = request_validation_cache_size
+        self.spec_registry = spec_registry
+        self._given_openapi_base_path = openapi_base_path
+        self._reload_lock = threading.Lock()
+        self._executor_lock = threading.Lock()
+        self._route_plans = weakref.WeakSet()
+        self._spec_watcher = None
+        self._apps = weakref.WeakSet()
+        self._deferred_openapi_def = openapi_def
+        self._spec_version = None
+        if not defer_spec_build:
+            self.spec_version = self._build_spec_version(openapi_def)
         self.validate_requests = validate_requests
         self.validate_responses = validate_responses
         self.auto_jsonify = auto_jsonify
+        self.json_encoder = json_encoder
+        self.max_request_body_size = max_request_body_size
+        self.stream_request_body_threshold = stream_request_body_threshold
+        self.offload_validation_threshold = offload_validation_threshold
+        self.validation_executor = validation_executor
+        self._owns_validation_executor = False
+        self.response_validation_sample_rate = response_validation_sample_rate
+        self.response_validation_sample_rates = dict(response_validation_sample_rates or {})
+        if shadow_response_validation:
+            # Each response is queued along with the response validator of the spec it was handled with.
+            self.shadow_validation_pool = ShadowValidationPool(
+                None,
+                error_handler=shadow_response_error_handler,
+                workers=shadow_validation_workers,
+                queue_size=shadow_validation_queue_size
+            )
+        else:
+            self.shadow_validation_pool = None
+        self.metrics_collector = MetricsCollector() if collect_metrics or serve_stats else None
+        self.metrics_sink = metrics_sink
+        self.serve_stats = serve_stats
+        self.stats_suburl = stats_suburl
+        self.stats_route_name = stats_route_name
         self.request_error_handler = request_error_handler
         self.response_error_handler = response_error_handler
         self.exception_handler = exception_handler
@@ -221,25 +592,188 @@ class OpenAPIPlugin(object):
         self.openapi_schema_route_name = openapi_schema_route_name
         self.swagger_ui_suburl = swagger_ui_suburl
 
-        self.openapi_base_path = openapi_base_path or urlparse(self.openapi_spec.default_url).path or '/'
+        self.openapi_base_path = openapi_base_path or _default_base_path(openapi_def)
         self.adjust_api_base_path = adjust_api_base_path
 
         fixed_base_path = (self.openapi_base_path.rstrip("/")) + "/"
         self.openapi_schema_url = urljoin(fixed_base_path, self.openapi_schema_suburl.lstrip("/"))
         self.swagger_ui_base_url = urljoin(fixed_base_path, self.swagger_ui_suburl.lstrip("/"))
+        self.stats_url = urljoin(fixed_base_path, self.stats_suburl.lstrip("/"))
         self.swagger_ui_route_name = swagger_ui_route_name
 
+    @property
+    def spec_version(self):
+        spec_version = self._spec_version
+        if spec_version is None:
+            with self._reload_lock:
+                if self._spec_version is None:
+                    self._spec_version = self._build_spec_version(self._deferred_openapi_def)
+                    self._deferred_openapi_def = None
+                spec_version = self._spec_version
+        return spec_version
+
+    @spec_version.setter
+    def spec_version(self, spec_version):
+        self._spec_version = spec_version
+        self._deferred_openapi_def = None
+
+    @property
+    def spec_built(self) -> bool:
+        return self._spec_version is not None
+
+    @property
+    def openapi_def(self):
+        if self._spec_version is None:
+            return self._deferred_openapi_def
+        return self._spec_version.openapi_def
+
+    @property
+    def openapi_spec(self):
+        return self.spec_version.openapi_spec
+
+    @property
+    def operation_index(self):
+        return self.spec_version.operation_index
+
+    @property
+    def request_validator(self):
+        return self.spec_version.request_validator
+
+    @property
+    def response_validator(self):
+        return self.spec_version.response_validator
+
+    @property
+    def request_validation_cache(self):
+        return self.spec_version.request_validation_cache
+
+    def _build_spec_version(self, openapi_def):
+        openapi_def = dict(openapi_def)
+        if self._given_openapi_base_path is not None:
+            openapi_def.update(basePath=self._given_openapi_base_path)
+        if self.spec_registry is not None:
+            # Spec versions are only shared between plugins whose request validation caches are the same size.
+            return self.spec_registry.get_or_build(
+                openapi_def, self._create_spec_version, validate=self.validate_openapi_spec,
+                variant=self.request_validation_cache_size
+            )
+        return self._create_spec_version(openapi_def, self.validate_openapi_spec)
+
+    def _create_spec_version(self, openapi_def, validate):
+        from .specs import build_spec
+        openapi_spec = build_spec(openapi_def, validate=validate, cache_dir=self.spec_cache_dir)
+        return _SpecVersion(openapi_def, openapi_spec, request_validation_cache_size=self.request_validation_cache_size)
+
+    def reload(self, openapi_def):
+        """
+        Switch over to a new OpenAPI specification without restarting. The new spec is validated and
+        built, and the routes the plugin has been applied to are planned against it, before it's swapped
+        in all at once; requests that are already being handled finish against the previous spec. If the
+        new spec can't be built (or fails validation), the error is raised and the previous spec stays
+        in use.
+
+        The routes the plugin serves its own schema, Swagger UI and stats under stay where they are,
+        even if the new spec has a different base path.
+
+        :param openapi_def: A dictionary representation of the new OpenAPI spec for this API.
+        :type openapi_def: dict
+        """
+        with self._reload_lock:
+            spec_version = self._build_spec_version(openapi_def)
+            route_plans = []
+            for plan in list(self._route_plans):
+                methods = plan.operation_plans[1] or ([plan.method] if plan.method != 'ANY' else [])
+                route_plans.append((plan, (spec_version, {
+                    method: self._make_operation_plan(spec_version, plan, method) for method in methods
+                })))
+            if self.serve_openapi_schema:
+                self._openapi_schema_payload('', spec_version=spec_version)
+            self.spec_version = spec_version
+            # Any request that got here first has already made its own plans for the new version, and
+            # these are just the same.
+            for plan, operation_plans in route_plans:
+                plan.operation_plans = operation_plans
+        openapi_3_plugin_logger.info("Reloaded the OpenAPI specification.")
+
+    def warmup(self):
+        """
+        Validate and build the specification now, if that was deferred, and prepare every route of the apps
+        the plugin is installed in, so that none of that work is left for the first requests to do.
+        """
+        spec_version = self.spec_version
+        for app in list(self._apps):
+            for route in app.routes:
+                # Applies the app's plugins to the route, planning it against the spec.
+                route.prepare()
+        if self.serve_openapi_schema:
+            self._openapi_schema_payload('', spec_version=spec_version)
+
+    def reload_from_file(self, path):
+        """
+        Reload the OpenAPI specification from a JSON (or, if PyYAML is installed, YAML) file.
+        See reload.
+        """
+        from .specs import load_spec_file
+        self.reload(load_spec_file(path))
+
+    def watch_spec_file(self, path, interval=1.0):
+        """
+        Reload the OpenAPI specification whenever the given file changes, checking for changes every
+        interval seconds on a background thread. Specs that fail to load are logged and otherwise
+        ignored, leaving the previous spec in use.
+
+        :param path: The path to a JSON or YAML OpenAPI specification file.
+        :type path: str
+        :param interval: How often to check the file for changes, in seconds.
+        :type interval: float
+        :return: The watcher, which can be stopped with its stop method.
+        :rtype: SpecFileWatcher
+        """
+        from .specs import SpecFileWatcher
+        if self._spec_watcher is not None:
+            self._spec_watcher.stop()
+        self._spec_watcher = SpecFileWatcher(path, self.reload_from_file, interval=interval)
+        self._spec_watcher.start()
+        return self._spec_watcher
+
+    def close(self):
+        """
+        Stop the plugin's background work: the shadow response validation threads, the spec file watcher,
+        and the validation executor if the plugin created it itself. Bottle calls this when the plugin is
+        uninstalled or the app is closed.
+        """
+        if self.shadow_validation_pool is not None:
+            self.shadow_validation_pool.close()
+        if self._spec_watcher is not None:
+            self._spec_watcher.stop()
+            self._spec_watcher = None
+        with self._executor_lock:
+            executor = self.validation_executor if self._owns_validation_executor else None
+            if executor is not None:
+                self.validation_executor = None
+                self._owns_validation_executor = False
+        if executor is not None:
+            executor.shutdown()
+
     def setup(self, app):
+        self._apps.add(app)
+        if self.spec_built:
+            for route in app.routes:
+                self._plan_route(route)
+
         if self.serve_openapi_schema:
             @app.get(self.openapi_schema_url, name=self.openapi_schema_route_name)
             def swagger_schema():
-                spec_dict = self.openapi_def
-                if self.adjust_api_base_path and "basePath" in spec_dict:
-                    spec_dict["basePath"] = urljoin(
-                        urljoin("/", request.environ.get('SCRIPT_NAME', '').strip('/') + '/'),
-                        self.openapi_base_path.lstrip("/")
-                    )
-                return spec_dict
+                return self._openapi_schema_payload(request.environ.get('SCRIPT_NAME', '')).respond(request)
+
+        if self.serve_stats:
+            @app.get(self.stats_url, name=self.stats_route_name)
+            def openapi_stats():
+                return HTTPResponse(
+                    json_dumps(self.metrics_collector.snapshot()),
+                    status=200,
+                    headers={'Content-Type': 'application/json', 'Cache-Control': 'no-store'}
+                )
 
         if self.serve_swagger_ui:
             @app.get(self.swagger_ui_base_url, name=self.swagger_ui_route_name)
@@ -256,69 +790,280 @@ class OpenAPIPlugin(object):
                     validator_url = self.swagger_ui_validator_url()
                 else:
                     validator_url = self.swagger_ui_validator_url
-                return _render_index_html(
+                return _swagger_ui_index_payload(
                     schema_url,
                     validator_url=validator_url
-                )
+                ).respond(request)
 
             @app.get(urljoin(self.swagger_ui_base_url, "<path:path>"))
             def swagger_ui_assets(path):
-                return static_file(path, SWAGGER_UI_DIR)
+                return _swagger_ui_assets().respond(request, path)
+
+    def _openapi_schema_payload(self, script_name, spec_version=None):
+        """
+        Get the serialized OpenAPI specification as served from under the given SCRIPT_NAME. The shared
+        specification dictionary is never modified; each base path variant gets its own serialized copy.
+        """
+        if spec_version is None:
+            spec_version = self.spec_version
+        openapi_def = spec_version.openapi_def
+        payloads = spec_version.openapi_schema_payloads
+        base_path = None
+        if self.adjust_api_base_path and "basePath" in openapi_def:
+            base_path = urljoin(
+                urljoin("/", script_name.strip('/') + '/'),
+                self.openapi_base_path.lstrip("/")
+            )
+        try:
+            return payloads[base_path]
+        except KeyError:
+            pass
+        spec_dict = openapi_def if base_path is None else dict(openapi_def, basePath=base_path)
+        payload = CachedPayload(json_dumps(spec_dict).encode("utf-8"), "application/json")
+        if len(payloads) < self.MAX_OPENAPI_SCHEMA_VARIANTS:
+            payloads[base_path] = payload
+        return payload
 
     def apply(self, callback, route):
+        plan = self._plan_route(route)
+        if plan is None:
+            return callback
+        self._route_plans.add(plan)
+
         @wraps(callback)
         def wrapper(*args, **kwargs):
-            return self._validate_this(callback, route, *args, **kwargs)
+            return self._validate_this(callback, plan, *args, **kwargs)
         return wrapper
 
-    def _validate_this(self, callback, route, *args, **kwargs):
+    def _bypass_route(self, route):
         if not route.rule.startswith(self.openapi_base_path):
-            return callback(*args, **kwargs)
+            return True
         elif self.serve_openapi_schema and route.rule == self.openapi_schema_url:
-            return callback(*args, **kwargs)
+            return True
         elif self.serve_swagger_ui and route.rule.startswith(self.swagger_ui_base_url):
-            return callback(*args, **kwargs)
-        else:
+            return True
+        elif self.serve_stats and route.rule == self.stats_url:
+            return True
+        return False
+
+    def _plan_route(self, route):
+        """
+        Build the validation plan for a route, or return None if the route isn't an API route
+        and should be left alone.
+        """
+        if self._bypass_route(route):
+            return None
+        full_url_pattern = _bottle_rule_to_openapi_path(route.rule)
+        config = self._route_config(route)
+        plan = _RoutePlan(
+            route.rule, route.method, full_url_pattern,
+            validate_requests=config.get('validate_requests', self.validate_requests),
+            validate_responses=config.get('validate_responses', self.validate_responses),
+            auto_jsonify=config.get('auto_jsonify', self.auto_jsonify),
+            response_validation_sample_rate=config.get('sample_rate'),
+            max_request_body_size=config.get('max_body')
+        )
+        if route.method != 'ANY' and self.spec_built:
+            # Routes bound to any method can only be planned once we see the actual request, and
+            # nothing can be planned until the spec is built.
+            self._plan_operation(self.spec_version, plan, route.method)
+        return plan
+
+    def _route_config(self, route):
+        """
+        Get the plugin settings from a route's config (the openapi3.* keys), without their prefix. Values
+        are converted to the setting's type (config files give strings), raising a ValueError if they can't be.
+        """
+        config = {}
+        for key, value in getattr(route, 'config', {}).items():
+            if not key.startswith(ROUTE_CONFIG_PREFIX):
+                continue
+            name = key[len(ROUTE_CONFIG_PREFIX):]
+            if name not in ROUTE_CONFIG_KEYS:
+                openapi_3_plugin_logger.warning("Ignoring unknown route config %s on route %s.", key, route.rule)
+                continue
+            try:
+                config[name] = _ROUTE_CONFIG_CONVERTERS[name](value)
+            except (TypeError, ValueError) as e:
+                raise ValueError("Invalid route config {0} on route {1} {2}: {3}".format(
+                    key, route.method, route.rule, e
+                ))
+        return config
+
+    def _plan_operation(self, spec_version, plan, method):
+        spec_version_planned, operation_plans = plan.operation_plans
+        if spec_version_planned is not spec_version:
+            operation_plans = {}
+            plan.operation_plans = (spec_version, operation_plans)
+        try:
+            return operation_plans[method]
+        except KeyError:
+            pass
+        operation_plan = operation_plans[method] = self._make_operation_plan(spec_version, plan, method)
+        return operation_plan
+
+    def _make_operation_plan(self, spec_version, plan, method):
+        indexed_operation = self._lookup_operation(spec_version, plan.rule, plan.full_url_pattern, method.lower())
+        return _OperationPlan(
+            plan, spec_version, indexed_operation,
+            max_request_body_size=self._max_request_body_size(plan, indexed_operation),
+            response_validation_sample_rate=self._response_validation_sample_rate(plan, indexed_operation),
+            operation_key=indexed_operation.key(method, plan.full_url_pattern)
+        )
+
+    def _plan_for_request(self, plan, req):
+        return self._plan_operation(self.spec_version, plan, plan.method if plan.method != 'ANY' else req.method)
+
+    @staticmethod
+    def _lookup_operation(spec_version, rule, full_url_pattern, method):
+        indexed_operation = spec_version.operation_index.lookup(rule, full_url_pattern, method)
+        spec_version.request_validator.precompile(indexed_operation)
+        spec_version.response_validator.precompile(indexed_operation)
+        return indexed_operation
+
+    def _max_request_body_size(self, plan, indexed_operation):
+        if plan.max_request_body_size is not None:
+            return plan.max_request_body_size
+        elif indexed_operation.max_request_body_size is not None:
+            return indexed_operation.max_request_body_size
+        return self.max_request_body_size
+
+    def _response_validation_sample_rate(self, plan, indexed_operation):
+        if plan.response_validation_sample_rate is not None:
+            return plan.response_validation_sample_rate
+        operation = indexed_operation.operation
+        if operation is not None and operation.operation_id in self.response_validation_sample_rates:
+            return self.response_validation_sample_rates[operation.operation_id]
+        return self.response_validation_sample_rate
+
+    def _record_metrics(self, plan, timer):
+        if self.metrics_collector is not None:
+            self.metrics_collector(plan.operation_key, timer.timings, timer.errors)
+        if self.metrics_sink is not None:
             try:
-                openapi_request = _bottle_request_to_openapi_request(request)
-                if self.validate_requests:
-                    request_validation_result = self.request_validator.validate(openapi_request)
+                self.metrics_sink(plan.operation_key, timer.timings, timer.errors)
+            except Exception:
+                openapi_3_plugin_logger.exception("Unhandled exception in the metrics sink.")
+
+    def _get_validation_executor(self):
+        if self.validation_executor is None:
+            with self._executor_lock:
+                if self.validation_executor is None:
+                    self.validation_executor = ThreadPoolExecutor(thread_name_prefix="openapi3-validation")
+                    self._owns_validation_executor = True
+        return self.validation_executor
+
+    def _run_validation(self, body_size, validate, *args):
+        """
+        Run a validator on the validation executor if the body being validated is large enough to be
+        worth it, waiting for its result, and otherwise right here.
+        """
+        if self.offload_validation_threshold is None or body_size < self.offload_validation_threshold:
+            return validate(*args)
+        return self._get_validation_executor().submit(validate, *args).result()
+
+    def _validate_this(self, callback, route_plan, *args, **kwargs):
+        if self.metrics_collector is not None or self.metrics_sink is not None:
+            timer = PhaseTimer()
+        else:
+            timer = None
+        plan = None
+        try:
+            plan = self._plan_for_request(route_plan, request)
+            indexed_operation = plan.indexed_operation
+            max_request_body_size = plan.max_request_body_size
+            stream_body = False
+            body_size = 0
+            if (max_request_body_size is not None or self.stream_request_body_threshold is not None or
+                    self.offload_validation_threshold is not None):
+                body_size = _request_body_size(request)
+                if max_request_body_size is not None and body_size > max_request_body_size:
+                    from openapi_core.validation.request.datatypes import RequestValidationResult
+                    from .validators import RequestBodyTooLarge
+                    errors = [RequestBodyTooLarge(body_size, max_request_body_size)]
+                    if timer is not None:
+                        timer.add_errors(errors)
+                    return self.request_error_handler(request, RequestValidationResult(errors=errors))
+                stream_body = (
+                    self.stream_request_body_threshold is not None and
+                    body_size > self.stream_request_body_threshold and
+                    _can_stream_request_body(request, indexed_operation)
+                )
+            openapi_request = _bottle_request_to_openapi_request(
+                request, plan.full_url_pattern, indexed_operation, stream_body=stream_body
+            )
+            if timer is not None:
+                timer.mark(REQUEST_CONVERSION)
+            if plan.validate_requests:
+                request_validation_result = self._run_validation(
+                    body_size, plan.spec_version.request_validator.validate, openapi_request
+                )
+                if timer is not None:
+                    timer.mark(REQUEST_VALIDATION)
+                    timer.add_errors(request_validation_result.errors)
+            else:
+                request_validation_result = None
+            if not plan.validate_requests or not request_validation_result.errors:
+                request.openapi_request = openapi_request
+                _share_request_validation_result(request, openapi_request, request_validation_result)
+                result = callback(*args, **kwargs)
+                if timer is not None:
+                    timer.mark(HANDLER)
+                # Auto-jsonified results are validated as they were encoded, since encoding can change them (tuples
+                # become arrays, keys become strings and so on). Checking whether it would costs more than reparsing.
+                if plan.auto_jsonify and isinstance(result, (dict, list)):
+                    response.content_type = 'application/json'
+                    response.body = result = self.json_encoder(result)
+                    result_response = response
+                elif plan.auto_jsonify and isinstance(result, HTTPResponse):
+                    response.content_type = result.content_type = 'application/json'
+                    result.body = self.json_encoder(result.body)
+                    result_response = result
+                elif isinstance(result, HTTPResponse):
+                    result_response = result
                 else:
-                    request_validation_result = None
-                if not self.validate_requests or not request_validation_result.errors:
-                    request.openapi_request = openapi_request
-                    result = callback(*args, **kwargs)
-                    if self.auto_jsonify and isinstance(result, (dict, list)):
-                        response.body = result = json_dumps(result)
-                        response.content_type = 'application/json'
-                        openapi_response = _bottle_response_to_openapi_response(response)
-                    elif self.auto_jsonify and isinstance(result, HTTPResponse):
-                        result.body = json_dumps(result.body)
-                        response.content_type = result.content_type = 'application/json'
-                        openapi_response = _bottle_response_to_openapi_response(result)
-                    elif isinstance(result, HTTPResponse):
-                        openapi_response = _bottle_response_to_openapi_response(result)
-                    else:
-                        response.body = result
-                        openapi_response = _bottle_response_to_openapi_response(response)
-                    if self.validate_responses:
-                        response_validation_result = self.response_validator.validate(openapi_request, openapi_response)
-                    else:
-                        response_validation_result = None
-                    if not self.validate_responses or not response_validation_result.errors:
-                        return result
-                    else:
-                        return self.response_error_handler(
-                            request,
-                            result if isinstance(result, Response) else response,
-                            response_validation_result
-                        )
+                    response.body = result
+                    result_response = response
+                if timer is not None:
+                    timer.mark(SERIALIZATION)
+                if not plan.validate_responses or not _sampled(plan.response_validation_sample_rate):
+                    return result
+                if self.shadow_validation_pool is not None:
+                    # Shadow validation works from the serialized body, so nothing the route holds on to can
+                    # change underneath it once the response has been sent.
+                    self.shadow_validation_pool.submit(
+                        openapi_request, _bottle_response_to_openapi_response(result_response),
+                        response_validator=plan.spec_version.response_validator
+                    )
+                    if timer is not None:
+                        timer.mark(RESPONSE_VALIDATION)
+                    return result
+                openapi_response = _bottle_response_to_openapi_response(result_response)
+                response_validation_result = self._run_validation(
+                    _response_body_size(result_response),
+                    plan.spec_version.response_validator.validate, openapi_request, openapi_response
+                )
+                if timer is not None:
+                    timer.mark(RESPONSE_VALIDATION)
+                    timer.add_errors(response_validation_result.errors)
+                if not response_validation_result.errors:
+                    return result
                 else:
-                    return self.request_error_handler(request, request_validation_result)
-            except Exception as e:
-                # Should we attempt to validate an HTTP response that was raised?
-                if isinstance(e, HTTPResponse):
-                    raise e
-                return self.exception_handler(request, e)
-            finally:
-                request.openapi_request = None
+                    return self.response_error_handler(
+                        request,
+                        result if isinstance(result, Response) else response,
+                        response_validation_result
+                    )
+            else:
+                return self.request_error_handler(request, request_validation_result)
+        except Exception as e:
+            # Should we attempt to validate an HTTP response that was raised?
+            if isinstance(e, HTTPResponse):
+                raise e
+            return self.exception_handler(request, e)
+        finally:
+            if timer is not None and plan is not None:
+                self._record_metrics(plan, timer)
+            request.openapi_request = None
+            request.openapi_body = None
+            request.openapi_params = None
@@ -0,0 +1,167 @@
+from bottle import HTTPError, HTTPResponse, Request
+import gzip
+import hashlib
+import mimetypes
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Compressing tiny payloads isn't worth the extra response variants.
+MIN_COMPRESSIBLE_SIZE = 1024
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# For anything whose URL stays the same when its content changes, so clients always check it's up to date.
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+COMPRESSIBLE_CONTENT_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+
+def _parse_accept_encoding(header: str) -> dict:
+    accepted = {}
+    for part in header.split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+    return accepted
+
+
+def _parse_if_none_match(header: str) -> set:
+    tags = set()
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag:
+            tags.add(tag)
+    return tags
+
+
+class CachedPayload(object):
+    """
+    A response body that is serialized and compressed once up front, and then served with a
+    content hash ETag so that clients which already have it get a 304 without any work being done.
+    """
+
+    def __init__(self, body: bytes, content_type: str, cache_control=None, compress=True):
+        self.body = body
+        self.content_type = content_type
+        self.cache_control = cache_control
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.etag = '"{0}"'.format(digest)
+        # Each encoding is a distinct representation, so it gets its own (related) ETag.
+        self.variants = {None: (body, self.etag)}
+        if compress and len(body) >= MIN_COMPRESSIBLE_SIZE:
+            if brotli is not None:
+                self.variants["br"] = (brotli.compress(body), '"{0}-br"'.format(digest))
+            self.variants["gzip"] = (gzip.compress(body, compresslevel=9), '"{0}-gzip"'.format(digest))
+        self._etags = set(etag for _, etag in self.variants.values())
+
+    def __len__(self):
+        return sum(len(body) for body, _ in self.variants.values())
+
+    def _select_encoding(self, req: Request):
+        if len(self.variants) == 1:
+            return None
+        accepted = _parse_accept_encoding(req.headers.get("Accept-Encoding", ""))
+        for coding in ("br", "gzip"):
+            if coding in self.variants and accepted.get(coding, accepted.get("*", 0.0)) > 0:
+                return coding
+        return None
+
+    def respond(self, req: Request) -> HTTPResponse:
+        headers = {"Content-Type": self.content_type}
+        if self.cache_control is not None:
+            headers["Cache-Control"] = self.cache_control
+        if len(self.variants) > 1:
+            headers["Vary"] = "Accept-Encoding"
+
+        if_none_match = req.headers.get("If-None-Match")
+        if if_none_match is not None:
+            tags = _parse_if_none_match(if_none_match)
+            if "*" in tags or tags & self._etags:
+                headers["ETag"] = self.variants[self._select_encoding(req)][1]
+                del headers["Content-Type"]
+                return HTTPResponse(status=304, headers=headers)
+
+        coding = self._select_encoding(req)
+        body, etag = self.variants[coding]
+        headers["ETag"] = etag
+        if coding is not None:
+            headers["Content-Encoding"] = coding
+        return HTTPResponse(body, status=200, headers=headers)
+
+
+class StaticAssetTable(object):
+    """
+    Serves the files under a directory from memory. Only files that existed when the table was
+    created can be served, and each one is read, compressed and hashed the first time it's asked for.
+    Files are served with the given Cache-Control, unless cache_controls has another one for their path.
+    """
+
+    def __init__(self, directory, cache_control=IMMUTABLE_CACHE_CONTROL, cache_controls=None):
+        self.directory = os.path.abspath(directory)
+        self.cache_control = cache_control
+        self.cache_controls = dict(cache_controls or {})
+        self._files = {}
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                full_path = os.path.join(root, filename)
+                asset_path = os.path.relpath(full_path, self.directory).replace(os.sep, "/")
+                self._files[asset_path] = full_path
+        self._payloads = {}
+
+    def __contains__(self, path):
+        return path in self._files
+
+    def __len__(self):
+        return len(self._files)
+
+    @staticmethod
+    def _content_type(path):
+        content_type, _ = mimetypes.guess_type(path)
+        if content_type is None:
+            return "application/octet-stream" if not path.endswith(".map") else "application/json"
+        if content_type.startswith("text/") or content_type == "application/javascript":
+            content_type += "; charset=UTF-8"
+        return content_type
+
+    def get(self, path):
+        """
+        Get the cached payload for an asset, or None if there is no such asset.
+        """
+        try:
+            return self._payloads[path]
+        except KeyError:
+            pass
+        if path not in self._files:
+            return None
+        with open(self._files[path], "rb") as f:
+            body = f.read()
+        content_type = self._content_type(path)
+        payload = CachedPayload(
+            body, content_type,
+            cache_control=self.cache_controls.get(path, self.cache_control),
+            compress=content_type.startswith(COMPRESSIBLE_CONTENT_TYPES)
+        )
+        self._payloads[path] = payload
+        return payload
+
+    def respond(self, req: Request, path: str) -> HTTPResponse:
+        payload = self.get(path)
+        if payload is None:
+            return HTTPError(404, "File does not exist.")
+        return payload.respond(req)
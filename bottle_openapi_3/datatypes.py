@@ -0,0 +1,109 @@
+from bottle import BaseRequest
+import attr
+
+
+# The parsed_body of requests whose body hasn't been parsed. This module is imported along with the package,
+# so it doesn't use openapi-core's NoValue, which would mean importing all of openapi-core up front too.
+NOT_PARSED = object()
+
+
+class LazyRequestMapping(object):
+    """
+    A read only view of one of a Bottle request's lazily parsed multi dicts (like its query or cookies),
+    which is only parsed if a value is actually looked up in it. Bottle caches the parsed dict in the
+    request's environ, so it's still parsed at most once per request.
+    """
+    __slots__ = ('_environ', '_attribute', '_mapping')
+
+    def __init__(self, environ, attribute):
+        self._environ = environ
+        self._attribute = attribute
+        self._mapping = None
+
+    @property
+    def mapping(self):
+        if self._mapping is None:
+            # Unlike BaseRequest(environ), this doesn't take over the environ's bottle.request entry.
+            request_view = BaseRequest.__new__(BaseRequest)
+            request_view.environ = self._environ
+            self._mapping = getattr(request_view, self._attribute)
+        return self._mapping
+
+    def __contains__(self, key):
+        return key in self.mapping
+
+    def __getitem__(self, key):
+        return self.mapping[key]
+
+    def __iter__(self):
+        return iter(self.mapping)
+
+    def __len__(self):
+        return len(self.mapping)
+
+    def get(self, key, default=None):
+        return self.mapping.get(key, default)
+
+    def getall(self, key):
+        return self.mapping.getall(key)
+
+    def keys(self):
+        return self.mapping.keys()
+
+    def items(self):
+        return self.mapping.items()
+
+    def __repr__(self):
+        if self._mapping is None:
+            return "<{0} {1} (not parsed)>".format(self.__class__.__name__, self._attribute)
+        return "<{0} {1} {2!r}>".format(self.__class__.__name__, self._attribute, dict(self._mapping))
+
+
+@attr.s(slots=True)
+class BottleRequestParameters(object):
+    """
+    Request parameters that look values up in the Bottle request itself, rather than in copies of
+    its headers and cookies. Headers are Bottle's (case insensitive) view of the WSGI environ, and the
+    query and cookies are only parsed if validation looks something up in them.
+    """
+    query = attr.ib(factory=dict)
+    header = attr.ib(factory=dict)
+    cookie = attr.ib(factory=dict)
+    path = attr.ib(factory=dict)
+
+    def __getitem__(self, location):
+        return getattr(self, location)
+
+
+@attr.s(slots=True)
+class BottleOpenAPIRequest(object):
+    """
+    An OpenAPI request that already knows which operation it is for, so the validators
+    don't have to go looking for it. Once the request is validated, parsed_body holds the
+    deserialized (but not yet unmarshalled) body.
+
+    Large bodies may be handed over as a binary body_stream instead of as the body itself, in which
+    case they are validated as they are read and never parsed into a single document.
+
+    This has the same attributes as openapi-core's OpenAPIRequest.
+    """
+    full_url_pattern = attr.ib()
+    method = attr.ib()
+    body = attr.ib()
+    mimetype = attr.ib()
+    parameters = attr.ib(factory=BottleRequestParameters)
+    indexed_operation = attr.ib(default=None)
+    parsed_body = attr.ib(default=NOT_PARSED)
+    body_stream = attr.ib(default=None)
+
+
+@attr.s(slots=True)
+class BottleOpenAPIResponse(object):
+    """
+    An OpenAPI response with __slots__, holding the serialized response body as its data.
+
+    This has the same attributes as openapi-core's OpenAPIResponse.
+    """
+    data = attr.ib()
+    status_code = attr.ib()
+    mimetype = attr.ib()
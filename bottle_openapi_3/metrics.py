@@ -0,0 +1,161 @@
+from collections import deque
+from time import perf_counter
+import threading
+import weakref
+
+
+REQUEST_CONVERSION = 'request_conversion'
+REQUEST_VALIDATION = 'request_validation'
+HANDLER = 'handler'
+SERIALIZATION = 'serialization'
+RESPONSE_VALIDATION = 'response_validation'
+
+PHASES = (REQUEST_CONVERSION, REQUEST_VALIDATION, HANDLER, SERIALIZATION, RESPONSE_VALIDATION)
+
+
+class PhaseTimer(object):
+    """
+    Times the consecutive phases of handling a single request, and collects the classes of any
+    validation errors along the way.
+    """
+    __slots__ = ('timings', 'errors', '_last')
+
+    def __init__(self):
+        self.timings = {}
+        self.errors = []
+        self._last = perf_counter()
+
+    def mark(self, phase):
+        """
+        End the given phase, which is taken to have started when the previous one ended.
+        """
+        now = perf_counter()
+        self.timings[phase] = now - self._last
+        self._last = now
+
+    def add_errors(self, errors):
+        self.errors.extend(type(error).__name__ for error in errors)
+
+
+class _OperationStats(object):
+    __slots__ = ('requests', 'counts', 'totals', 'maximums', 'errors')
+
+    def __init__(self):
+        self.requests = 0
+        self.counts = {}
+        self.totals = {}
+        self.maximums = {}
+        self.errors = {}
+
+    def add(self, timings, errors):
+        self.requests += 1
+        for phase, elapsed in timings.items():
+            self.counts[phase] = self.counts.get(phase, 0) + 1
+            self.totals[phase] = self.totals.get(phase, 0.0) + elapsed
+            if elapsed > self.maximums.get(phase, 0.0):
+                self.maximums[phase] = elapsed
+        for error in errors:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    def merge(self, other):
+        self.requests += other.requests
+        for phase, count in other.counts.items():
+            self.counts[phase] = self.counts.get(phase, 0) + count
+            self.totals[phase] = self.totals.get(phase, 0.0) + other.totals[phase]
+            if other.maximums[phase] > self.maximums.get(phase, 0.0):
+                self.maximums[phase] = other.maximums[phase]
+        for error, count in other.errors.items():
+            self.errors[error] = self.errors.get(error, 0) + count
+
+
+class _ShardHolder(object):
+    # Held in a thread local, so it goes away along with the thread (or greenlet) it belongs to.
+    __slots__ = ('shard', '__weakref__')
+
+    def __init__(self, shard):
+        self.shard = shard
+
+
+class MetricsCollector(object):
+    """
+    Aggregates per operation phase timings and validation error counts in process.
+
+    Each thread records into its own set of counters, so recording never takes a lock; the counters
+    are only combined when a snapshot is taken. The counters of threads (or, under gevent, greenlets)
+    that have finished are folded into a shared total, so they don't pile up.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = {}
+        self._totals = {}
+        # Shards of finished threads, which are only folded into the totals while holding the lock,
+        # since a thread can finish at any time, including while the lock is held.
+        self._finished_shards = deque()
+        self._shards_lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.holder.shard
+        except AttributeError:
+            pass
+        shard = {}
+        holder = self._local.holder = _ShardHolder(shard)
+        weakref.finalize(holder, self._finished_shards.append, shard)
+        with self._shards_lock:
+            self._fold_finished_shards()
+            self._shards[id(shard)] = shard
+        return shard
+
+    def _fold_finished_shards(self):
+        while self._finished_shards:
+            shard = self._finished_shards.popleft()
+            if self._shards.pop(id(shard), None) is not shard:
+                continue
+            for operation_key, stats in shard.items():
+                try:
+                    self._totals[operation_key].merge(stats)
+                except KeyError:
+                    self._totals[operation_key] = stats
+
+    def __call__(self, operation_key, timings, errors):
+        shard = self._shard()
+        try:
+            stats = shard[operation_key]
+        except KeyError:
+            stats = shard[operation_key] = _OperationStats()
+        stats.add(timings, errors)
+
+    def snapshot(self) -> dict:
+        """
+        Get the statistics recorded so far, by operation. Phase times are in milliseconds.
+        """
+        with self._shards_lock:
+            self._fold_finished_shards()
+            shards = list(self._shards.values())
+            totals = {operation_key: _OperationStats() for operation_key in self._totals}
+            for operation_key, stats in self._totals.items():
+                totals[operation_key].merge(stats)
+        merged = {}
+        for shard in [totals] + shards:
+            for operation_key, stats in list(shard.items()):
+                operation = merged.setdefault(operation_key, {'requests': 0, 'phases': {}, 'errors': {}})
+                operation['requests'] += stats.requests
+                for phase, count in list(stats.counts.items()):
+                    phase_stats = operation['phases'].setdefault(phase, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+                    phase_stats['count'] += count
+                    phase_stats['total_ms'] += stats.totals.get(phase, 0.0) * 1000.0
+                    phase_stats['max_ms'] = max(phase_stats['max_ms'], stats.maximums.get(phase, 0.0) * 1000.0)
+                for error, count in list(stats.errors.items()):
+                    operation['errors'][error] = operation['errors'].get(error, 0) + count
+        for operation in merged.values():
+            for phase_stats in operation['phases'].values():
+                phase_stats['mean_ms'] = phase_stats['total_ms'] / phase_stats['count']
+        return merged
+
+    def reset(self):
+        with self._shards_lock:
+            self._fold_finished_shards()
+            self._totals.clear()
+            for shard in self._shards.values():
+                shard.clear()
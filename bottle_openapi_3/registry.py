@@ -0,0 +1,202 @@
+from collections import deque
+import gc
+import hashlib
+import json
+import logging
+import sys
+import threading
+import types
+import weakref
+
+
+openapi_3_registry_logger = logging.getLogger(__name__)
+
+# Objects that aren't part of any one spec, and that memory_usage never counts.
+_UNCOUNTED_TYPES = (
+    type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType, types.CodeType
+)
+
+
+def _component_digest(schema) -> str:
+    from .specs import _without_ref_scopes
+    return hashlib.sha256(json.dumps(
+        _without_ref_scopes(schema), sort_keys=True, separators=(',', ':'), default=str
+    ).encode('utf-8')).hexdigest()
+
+
+def _deep_sizeof(root, seen) -> int:
+    """
+    The approximate size in bytes of everything reachable from root that isn't already in seen (by id),
+    adding what it counts to seen.
+    """
+    total = 0
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _UNCOUNTED_TYPES):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return total
+
+
+class _RegisteredSpec(object):
+    __slots__ = ('key', 'version', 'validated', 'component_digests', 'hits', '__weakref__')
+
+    def __init__(self, key, version, validated, component_digests):
+        self.key = key
+        self.version = weakref.ref(version)
+        self.validated = validated
+        self.component_digests = component_digests
+        self.hits = 0
+
+
+class SpecRegistry(object):
+    """
+    A registry of built specs (along with their validators and compiled schemas) by the digest of their
+    specification, so that plugins created for the very same specification share a single copy of all of it.
+
+    The source definitions of schemas under components/schemas are also deduplicated by their content across
+    every specification in the registry, so specifications that overlap keep only one copy of the definitions
+    they have in common. The openapi-core schemas and compiled validators built from them are still per spec.
+    Specs are only held on to for as long as a plugin is still using them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._specs = {}
+        # Shared component schemas by digest, as [schema, number of registered specs using it].
+        self._components = {}
+        # Specs that are no longer in use are only removed the next time the registry is used, since the
+        # garbage collector can get rid of them at any time, including while the lock is held.
+        self._released = deque()
+
+    def __len__(self):
+        with self._lock:
+            self._purge()
+            return len(self._specs)
+
+    def get_or_build(self, openapi_def, build, validate=True, variant=None):
+        """
+        Get the spec version registered for the given specification and variant, or build and register one
+        with build(openapi_def, validate) if there isn't one yet. Specs that were registered without being
+        validated are validated (once) the first time they're asked for with validate on.
+
+        :param openapi_def: A dictionary representation of an OpenAPI spec.
+        :type openapi_def: dict
+        :param build: An arity 2 callable that builds a spec version from a specification dictionary.
+        :type build: Callable
+        :param validate: Should the specification have been validated?
+        :type validate: bool
+        :param variant: Anything else (hashable) that spec versions built for this specification differ by.
+        """
+        from .specs import spec_digest, validate_spec
+        key = (spec_digest(openapi_def), variant)
+        with self._lock:
+            self._purge()
+            registered = self._specs.get(key)
+            version = registered.version() if registered is not None else None
+            if version is not None:
+                if validate and not registered.validated:
+                    validate_spec(version.openapi_def)
+                    registered.validated = True
+                registered.hits += 1
+                return version
+            elif registered is not None:
+                self._unregister(registered)
+
+            openapi_def, component_digests = self._intern_components(openapi_def)
+            try:
+                version = build(openapi_def, validate)
+            except BaseException:
+                self._release_components(component_digests)
+                raise
+            registered = _RegisteredSpec(key, version, validate, component_digests)
+            self._specs[key] = registered
+            weakref.finalize(version, self._released.append, registered)
+        openapi_3_registry_logger.debug("Registered spec %s.", key[0])
+        return version
+
+    def _intern_components(self, openapi_def):
+        schemas = (openapi_def.get('components') or {}).get('schemas')
+        if not schemas:
+            return openapi_def, ()
+        shared_schemas = {}
+        component_digests = []
+        for name, schema in schemas.items():
+            digest = _component_digest(schema)
+            shared = self._components.get(digest)
+            if shared is None:
+                shared = self._components[digest] = [schema, 0]
+            shared[1] += 1
+            shared_schemas[name] = shared[0]
+            component_digests.append(digest)
+        # The dictionaries given are left as they are, and only the copies share schemas.
+        components = dict(openapi_def['components'], schemas=shared_schemas)
+        return dict(openapi_def, components=components), tuple(component_digests)
+
+    def _release_components(self, component_digests):
+        for digest in component_digests:
+            shared = self._components[digest]
+            shared[1] -= 1
+            if not shared[1]:
+                del self._components[digest]
+
+    def _unregister(self, registered):
+        # Specs that were cleared from the registry (or already unregistered) have nothing left to release.
+        if self._specs.get(registered.key) is registered:
+            del self._specs[registered.key]
+            self._release_components(registered.component_digests)
+
+    def _purge(self):
+        while self._released:
+            self._unregister(self._released.popleft())
+
+    def clear(self):
+        """
+        Forget every registered spec. Plugins that are already using them carry on doing so.
+        """
+        with self._lock:
+            self._specs.clear()
+            self._components.clear()
+            self._released.clear()
+
+    def memory_usage(self) -> dict:
+        """
+        Approximately how much memory each registered spec uses, in bytes, including its specification
+        dictionary, validators and compiled schemas. Component schema definitions shared between specifications
+        are counted once, under shared_components, rather than against each spec that uses them.
+        """
+        from jsonschema.validators import RefResolver
+        with self._lock:
+            self._purge()
+            registered_specs = [(registered, registered.version()) for registered in self._specs.values()]
+            shared_schemas = [schema for schema, _ in self._components.values()]
+
+        # jsonschema's meta schemas are in every spec's reference resolver, but aren't part of any of them.
+        resolver = RefResolver('', {})
+        seen = set()
+        _deep_sizeof(resolver, seen)
+        usage = {
+            'shared_components': {'count': len(shared_schemas), 'bytes': _deep_sizeof(shared_schemas, seen)},
+            'specs': [],
+        }
+        for registered, version in registered_specs:
+            if version is None:
+                continue
+            info = version.openapi_def.get('info') or {}
+            usage['specs'].append({
+                'digest': registered.key[0],
+                'variant': registered.key[1],
+                'title': info.get('title'),
+                'version': info.get('version'),
+                'indexed_operations': len(version.operation_index),
+                'hits': registered.hits,
+                'bytes': _deep_sizeof(version, seen),
+            })
+        return usage
+
+
+# A registry for every plugin in the process to share, by passing it as their spec_registry.
+default_spec_registry = SpecRegistry()
@@ -0,0 +1,366 @@
+"""
+Validate captured traffic against an OpenAPI specification, offline.
+
+Records are read from JSON lines files (optionally gzipped), one request/response pair per line:
+
+    {"request": {"method": "POST", "url": "/pets?dry_run=1", "headers": {"Content-Type": "application/json"},
+                 "body": "{\"name\": \"Rex\"}"},
+     "response": {"status": 201, "headers": {"Content-Type": "application/json"}, "body": "{\"id\": 1}"}}
+
+Bodies can be given base64 encoded as body_base64 instead, and the response can be left out to only validate
+the request. HAR files (with a .har extension, or --format har) are also supported, though unlike JSON lines
+files they have to be read into memory in full.
+
+Requests and responses are converted and validated exactly as OpenAPIPlugin does it, spread across a pool of
+worker processes that each build the spec once.
+
+    python -m bottle_openapi_3.replay openapi.json traffic.jsonl.gz --workers 8
+"""
+from bottle import BaseRequest, BaseResponse
+from collections import OrderedDict, deque
+from itertools import islice
+from six.moves.urllib.parse import unquote, urlsplit
+import argparse
+import base64
+import gzip
+import io
+import json
+import logging
+import multiprocessing
+import os
+import sys
+
+from . import _bottle_request_to_openapi_request, _bottle_response_to_openapi_response
+from .specs import build_spec, load_spec_file, prebuild_spec
+from .validators import IndexedRequestValidator, IndexedResponseValidator, OperationIndex
+
+
+openapi_3_replay_logger = logging.getLogger(__name__)
+
+UNMATCHED_OPERATION = '<unmatched>'
+UNREADABLE_RECORD = '<unreadable>'
+# Records that something went wrong validating, other than them failing validation.
+FAILED_RECORD = '<failed>'
+
+
+def _header_items(headers):
+    if headers is None:
+        return []
+    if isinstance(headers, dict):
+        return list(headers.items())
+    # HAR style [{"name": ..., "value": ...}] lists, or [name, value] pairs.
+    return [(h['name'], h['value']) if isinstance(h, dict) else tuple(h) for h in headers]
+
+
+def _record_body(message, har_body=None):
+    if har_body is not None:
+        text = har_body.get('text')
+        if text is None:
+            return b''
+        if har_body.get('encoding') == 'base64':
+            return base64.b64decode(text)
+        return text.encode('utf-8')
+    if message.get('body_base64') is not None:
+        return base64.b64decode(message['body_base64'])
+    body = message.get('body')
+    if body is None:
+        return b''
+    elif isinstance(body, bytes):
+        return body
+    elif isinstance(body, (dict, list)):
+        # Logs often capture JSON bodies as the JSON itself, rather than as a string.
+        return json.dumps(body).encode('utf-8')
+    return body.encode('utf-8')
+
+
+def _request_environ(method, url, headers, body):
+    parsed = urlsplit(url)
+    environ = {
+        'REQUEST_METHOD': method.upper(),
+        # Bottle expects PEP 3333 (latin-1 decoded) paths.
+        'PATH_INFO': unquote(parsed.path or '/').encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': parsed.query,
+        'SCRIPT_NAME': '',
+        'SERVER_NAME': parsed.hostname or 'localhost',
+        'SERVER_PORT': str(parsed.port or 80),
+        'wsgi.url_scheme': parsed.scheme or 'http',
+        'wsgi.input': io.BytesIO(body),
+        'CONTENT_LENGTH': str(len(body)),
+        # There's no route to have matched any path arguments, so they're taken from the spec's path.
+        'route.url_args': {},
+    }
+    for name, value in headers:
+        key = name.upper().replace('-', '_')
+        if key == 'CONTENT_LENGTH':
+            continue
+        if key != 'CONTENT_TYPE':
+            key = 'HTTP_' + key
+        environ[key] = value if key not in environ else environ[key] + ', ' + value
+    return environ
+
+
+def parse_record(record, har=False):
+    """
+    Turn a JSON lines or HAR record into a Bottle request and (if the record has one) response.
+    """
+    request_record = record['request']
+    response_record = record.get('response')
+    body = _record_body(request_record, request_record.get('postData', {}) if har else None)
+    req = BaseRequest(_request_environ(
+        request_record['method'], request_record['url'], _header_items(request_record.get('headers')), body
+    ))
+    if response_record is None:
+        return req, None
+    resp = BaseResponse(
+        body=_record_body(response_record, response_record.get('content', {}) if har else None),
+        status=int(response_record['status']),
+        headers=_header_items(response_record.get('headers'))
+    )
+    return req, resp
+
+
+class ReplayValidator(object):
+    """
+    Validates recorded requests and responses against a spec, looking operations up by request path
+    (with a bounded cache of recently seen paths) since there are no routes to index them by.
+    """
+
+    def __init__(self, openapi_spec, operation_cache_size=10000):
+        self.operation_index = OperationIndex(openapi_spec)
+        self.request_validator = IndexedRequestValidator(openapi_spec)
+        self.response_validator = IndexedResponseValidator(openapi_spec)
+        self.operation_cache_size = operation_cache_size
+        self._operations = OrderedDict()
+
+    def _lookup(self, method, path):
+        key = (method, path)
+        try:
+            indexed_operation = self._operations[key]
+            self._operations.move_to_end(key)
+            return indexed_operation
+        except KeyError:
+            pass
+        indexed_operation = self.operation_index.find(path, method)
+        self.request_validator.precompile(indexed_operation)
+        self.response_validator.precompile(indexed_operation)
+        self._operations[key] = indexed_operation
+        if len(self._operations) > self.operation_cache_size:
+            self._operations.popitem(last=False)
+        return indexed_operation
+
+    def validate(self, req, resp=None):
+        """
+        Validate a request, and its response if given, returning the operation's name along with
+        the request and response validation errors.
+        """
+        method = req.method.lower()
+        indexed_operation = self._lookup(method, req.path)
+        if indexed_operation.error is None:
+            operation_key = indexed_operation.key(method, indexed_operation.path.name)
+        else:
+            operation_key = UNMATCHED_OPERATION
+        openapi_request = _bottle_request_to_openapi_request(req, req.path, indexed_operation)
+        request_errors = self.request_validator.validate(openapi_request).errors
+        if resp is None or indexed_operation.error is not None:
+            return operation_key, request_errors, []
+        openapi_response = _bottle_response_to_openapi_response(resp)
+        response_errors = self.response_validator.validate(openapi_request, openapi_response).errors
+        return operation_key, request_errors, response_errors
+
+
+class ReplayReport(object):
+    """
+    Record and error counts by operation, and error counts by error class within each operation.
+    """
+
+    def __init__(self):
+        self.records = 0
+        self.operations = {}
+
+    def _operation(self, operation_key):
+        try:
+            return self.operations[operation_key]
+        except KeyError:
+            operation = self.operations[operation_key] = {
+                'records': 0, 'invalid_requests': 0, 'invalid_responses': 0,
+                'request_errors': {}, 'response_errors': {}
+            }
+            return operation
+
+    def add(self, operation_key, request_errors, response_errors):
+        operation = self._operation(operation_key)
+        self.records += 1
+        operation['records'] += 1
+        operation['invalid_requests'] += bool(request_errors)
+        operation['invalid_responses'] += bool(response_errors)
+        for error in request_errors:
+            name = type(error).__name__
+            operation['request_errors'][name] = operation['request_errors'].get(name, 0) + 1
+        for error in response_errors:
+            name = type(error).__name__
+            operation['response_errors'][name] = operation['response_errors'].get(name, 0) + 1
+
+    def merge(self, other):
+        self.records += other.records
+        for operation_key, other_operation in other.operations.items():
+            operation = self._operation(operation_key)
+            for field in ('records', 'invalid_requests', 'invalid_responses'):
+                operation[field] += other_operation[field]
+            for field in ('request_errors', 'response_errors'):
+                for name, count in other_operation[field].items():
+                    operation[field][name] = operation[field].get(name, 0) + count
+
+    @property
+    def invalid_records(self):
+        return sum(
+            operation['invalid_requests'] + operation['invalid_responses'] for operation in self.operations.values()
+        )
+
+    def to_dict(self):
+        return {'records': self.records, 'operations': self.operations}
+
+    def format(self):
+        lines = ['{0:<50} {1:>10} {2:>16} {3:>17}'.format(
+            'operation', 'records', 'invalid requests', 'invalid responses'
+        )]
+        for operation_key, operation in sorted(self.operations.items()):
+            lines.append('{0:<50} {1:>10} {2:>16} {3:>17}'.format(
+                operation_key, operation['records'], operation['invalid_requests'], operation['invalid_responses']
+            ))
+            for kind in ('request', 'response'):
+                for name, count in sorted(operation[kind + '_errors'].items(), key=lambda item: -item[1]):
+                    lines.append('    {0:<10} {1:<35} {2:>10}'.format(kind, name, count))
+        lines.append('{0} records, {1} invalid requests or responses'.format(self.records, self.invalid_records))
+        return '\n'.join(lines)
+
+
+_worker_validator = None
+
+
+def _init_worker(openapi_def, spec_cache_dir):
+    global _worker_validator
+    # The spec has already been validated; with fork, the one prebuilt by the parent is reused as is.
+    _worker_validator = ReplayValidator(build_spec(openapi_def, validate=False, cache_dir=spec_cache_dir))
+
+
+def replay_batch(records, har=False, validator=None):
+    """
+    Validate a batch of raw records (JSON lines or HAR entries), returning a ReplayReport.
+    """
+    validator = validator or _worker_validator
+    report = ReplayReport()
+    for record in records:
+        try:
+            if not isinstance(record, dict):
+                record = json.loads(record)
+            req, resp = parse_record(record, har=har)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            report.add(UNREADABLE_RECORD, [e], [])
+            continue
+        try:
+            result = validator.validate(req, resp)
+        except Exception as e:
+            # One odd record shouldn't bring down the rest of the run.
+            openapi_3_replay_logger.debug("Unable to validate record %r", record, exc_info=True)
+            report.add(FAILED_RECORD, [e], [])
+            continue
+        report.add(*result)
+    return report
+
+
+def _open_records(path):
+    if path == '-':
+        return sys.stdin.buffer
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def iter_batches(path, batch_size, har=False):
+    """
+    Read records in batches. JSON lines files are streamed, and records are only parsed by the workers.
+    """
+    if har:
+        with _open_records(path) as f:
+            entries = json.load(f)['log']['entries']
+        for start in range(0, len(entries), batch_size):
+            yield entries[start:start + batch_size]
+        return
+    with _open_records(path) as f:
+        lines = (line for line in f if line.strip())
+        while True:
+            batch = list(islice(lines, batch_size))
+            if not batch:
+                return
+            yield batch
+
+
+def replay(openapi_def, path, workers=None, batch_size=1000, har=False, validate_spec=True, spec_cache_dir=None):
+    """
+    Validate all of the records in a traffic log against a spec, returning a ReplayReport.
+    """
+    # Build (and validate) the spec once up front, so forked workers can share it.
+    prebuild_spec(openapi_def, validate=validate_spec, cache_dir=spec_cache_dir)
+    report = ReplayReport()
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        validator = ReplayValidator(build_spec(openapi_def, validate=False))
+        for batch in iter_batches(path, batch_size, har=har):
+            report.merge(replay_batch(batch, har=har, validator=validator))
+        return report
+
+    pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(openapi_def, spec_cache_dir))
+    try:
+        # Only keep a few batches per worker in flight, so large logs aren't read into memory all at once.
+        pending = deque()
+        for batch in iter_batches(path, batch_size, har=har):
+            pending.append(pool.apply_async(replay_batch, (batch, har)))
+            if len(pending) >= workers * 4:
+                report.merge(pending.popleft().get())
+        while pending:
+            report.merge(pending.popleft().get())
+    finally:
+        pool.terminate()
+        pool.join()
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='bottle-openapi-3-replay', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('spec', help='The OpenAPI specification, as a JSON (or, with PyYAML, YAML) file.')
+    parser.add_argument('traffic', help='The traffic log; a JSON lines file (optionally gzipped), a HAR file or -.')
+    parser.add_argument('--format', choices=('jsonl', 'har'), help='The traffic log format, if not from its name.')
+    parser.add_argument('--workers', type=int, help='The number of worker processes. Defaults to one per CPU.')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Records per batch handed to a worker.')
+    parser.add_argument('--spec-cache-dir', help='A directory to cache the built spec in between runs.')
+    parser.add_argument('--no-validate-spec', action='store_true', help="Don't validate the specification itself.")
+    parser.add_argument('--json', dest='json_output', help='Also write the report as JSON to this file.')
+    parser.add_argument('--fail-on-errors', action='store_true',
+                        help='Exit with a non-zero status if any request or response was invalid.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    har = args.format == 'har' or (args.format is None and args.traffic.endswith('.har'))
+    report = replay(
+        load_spec_file(args.spec), args.traffic,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        har=har,
+        validate_spec=not args.no_validate_spec,
+        spec_cache_dir=args.spec_cache_dir
+    )
+    print(report.format())
+    if args.json_output:
+        with open(args.json_output, 'w') as f:
+            json.dump(report.to_dict(), f, indent=2, sort_keys=True)
+    if args.fail_on_errors and report.invalid_records:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+from six.moves import queue
+import logging
+import os
+import threading
+
+
+openapi_3_shadow_logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def default_shadow_response_error_handler(openapi_request, openapi_response, response_validation_result):
+    openapi_3_shadow_logger.error(
+        "Shadow response validation failure! Request: {0} {1}, Status: {2}, Result: {3}"
+        "".format(
+            openapi_request.method.upper(), openapi_request.full_url_pattern,
+            openapi_response.status_code, response_validation_result
+        )
+    )
+
+
+class ShadowValidationPool(object):
+    """
+    Validates responses on a small pool of background threads, after they've already been sent back to
+    the client. Work is handed over through a bounded queue, and is dropped rather than waited on when
+    the queue is full, so shadow validation never adds latency to a request.
+
+    The threads are started on first use (and restarted in forked children), so a pool can safely be
+    created before a pre-fork server forks its workers.
+    """
+
+    def __init__(self, response_validator, error_handler=default_shadow_response_error_handler,
+                 workers=1, queue_size=1000):
+        self.response_validator = response_validator
+        self.error_handler = error_handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.submitted = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = None
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._threads = [
+                threading.Thread(target=self._run, name="openapi3-shadow-validation-{0}".format(i))
+                for i in range(self.workers)
+            ]
+            for thread in self._threads:
+                thread.daemon = True
+                thread.start()
+            self._pid = os.getpid()
+
+    def submit(self, openapi_request, openapi_response, response_validator=None) -> bool:
+        """
+        Queue a response for validation, with the pool's response validator unless another one is
+        given. Returns False if it was dropped because the queue was full.
+        """
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((openapi_request, openapi_response, response_validator or self.response_validator))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def _run(self):
+        work_queue = self._queue
+        while True:
+            item = work_queue.get()
+            try:
+                if item is _STOP:
+                    return
+                openapi_request, openapi_response, response_validator = item
+                result = response_validator.validate(openapi_request, openapi_response)
+                if result.errors:
+                    with self._lock:
+                        self.failed += 1
+                    self.error_handler(openapi_request, openapi_response, result)
+            except Exception:
+                openapi_3_shadow_logger.exception("Unhandled exception during shadow response validation.")
+            finally:
+                work_queue.task_done()
+
+    def join(self):
+        """
+        Wait for all of the queued responses to be validated.
+        """
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def close(self):
+        """
+        Finish validating the queued responses and stop the worker threads.
+        """
+        if self._pid != os.getpid():
+            return
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._pid = None
@@ -0,0 +1,286 @@
+from jsonschema.validators import RefResolver
+from openapi_core.schema.schemas.models import Schema
+from openapi_core.schema.schemas.types import NoValue
+from openapi_core.schema.specs.factories import SpecFactory
+from openapi_spec_validator import default_handlers, validate_spec
+import copyreg
+import hashlib
+import io
+import json
+import logging
+import openapi_core
+import openapi_spec_validator
+import os
+import pickle
+import sys
+import tempfile
+import threading
+
+
+openapi_3_specs_logger = logging.getLogger(__name__)
+
+# Specs built in this process ahead of time (e.g. in a pre-fork server's master process), as
+# (spec, validated) pairs by digest.
+_PREBUILT_SPECS = {}
+
+# openapi-core's Schema overrides __dict__ to return the schema's source document, so pickle can't
+# see its real attributes; they're listed out here instead.
+_SCHEMA_ATTRIBUTES = (
+    'type', 'properties', 'items', 'format', 'required', 'default', 'nullable', 'enum', 'deprecated',
+    'all_of', 'one_of', 'additional_properties', 'min_items', 'max_items', 'min_length', 'max_length',
+    'pattern', 'unique_items', 'minimum', 'maximum', 'multiple_of', 'exclusive_minimum', 'exclusive_maximum',
+    'min_properties', 'max_properties', 'read_only', 'write_only', 'extensions',
+    '_all_required_properties_cache', '_all_optional_properties_cache', '_source',
+)
+
+_SPEC_RESOLVER_PERSISTENT_ID = 'bottle_openapi_3.spec_resolver'
+_NO_VALUE_PERSISTENT_ID = 'bottle_openapi_3.no_value'
+
+
+def _reduce_schema(schema):
+    # A (None, slotstate) state makes unpickling setattr() each attribute rather than touch __dict__.
+    return copyreg.__newobj__, (Schema, ), (None, {name: getattr(schema, name) for name in _SCHEMA_ATTRIBUTES})
+
+
+class _SpecPickler(pickle.Pickler):
+    dispatch_table = copyreg.dispatch_table.copy()
+    dispatch_table[Schema] = _reduce_schema
+
+    def persistent_id(self, obj):
+        # The reference resolver holds on to URL handlers and caches that can't (and needn't) be pickled.
+        if isinstance(obj, RefResolver):
+            return _SPEC_RESOLVER_PERSISTENT_ID
+        # Sentinels are compared by identity, so they have to come back as the very same object.
+        if obj is NoValue:
+            return _NO_VALUE_PERSISTENT_ID
+        return None
+
+
+class _SpecUnpickler(pickle.Unpickler):
+
+    def __init__(self, file, resolver):
+        super(_SpecUnpickler, self).__init__(file)
+        self.resolver = resolver
+
+    def persistent_load(self, pid):
+        if pid == _SPEC_RESOLVER_PERSISTENT_ID:
+            return self.resolver
+        if pid == _NO_VALUE_PERSISTENT_ID:
+            return NoValue
+        raise pickle.UnpicklingError("Unknown persistent id: {0!r}".format(pid))
+
+
+def _create_spec_resolver(openapi_def):
+    return RefResolver('', openapi_def, handlers=default_handlers)
+
+
+def _without_ref_scopes(value):
+    # openapi-spec-validator annotates $ref objects with an x-scope key as it validates (and so builds) a
+    # specification, which shouldn't change what the specification hashes to.
+    if isinstance(value, dict):
+        return {
+            k: _without_ref_scopes(v) for k, v in value.items()
+            if not (k == 'x-scope' and '$ref' in value)
+        }
+    elif isinstance(value, list):
+        return [_without_ref_scopes(v) for v in value]
+    return value
+
+
+def spec_digest(openapi_def) -> str:
+    """
+    A hash of an OpenAPI specification and the versions of everything that goes into building it.
+    """
+    from . import __version__
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps(
+        _without_ref_scopes(openapi_def), sort_keys=True, separators=(',', ':'), default=str
+    ).encode('utf-8'))
+    hasher.update(repr((
+        __version__, openapi_core.__version__, openapi_spec_validator.__version__, sys.version_info[:2]
+    )).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def create_spec(openapi_def, validate=True):
+    """
+    Build an openapi-core spec from a specification dictionary. Unlike openapi_core.create_spec, the
+    specification is only validated if asked to.
+    """
+    if validate:
+        validate_spec(openapi_def)
+    spec_factory = SpecFactory(_create_spec_resolver(openapi_def), config={'validate_spec': False})
+    return spec_factory.create(openapi_def)
+
+
+def dumps_spec(spec) -> bytes:
+    buf = io.BytesIO()
+    _SpecPickler(buf, protocol=pickle.HIGHEST_PROTOCOL).dump(spec)
+    return buf.getvalue()
+
+
+def loads_spec(data: bytes, openapi_def):
+    return _SpecUnpickler(io.BytesIO(data), _create_spec_resolver(openapi_def)).load()
+
+
+class SpecCache(object):
+    """
+    An on disk cache of validated and built specs, keyed by spec_digest.
+
+    Cached specs are pickled, so the cache directory must only be writable by the application itself.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, digest, suffix):
+        return os.path.join(self.directory, "{0}.{1}".format(digest, suffix))
+
+    def _write(self, path, data: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def is_validated(self, digest) -> bool:
+        return os.path.exists(self._path(digest, "validated"))
+
+    def mark_validated(self, digest):
+        self._write(self._path(digest, "validated"), b"")
+
+    def load(self, digest, openapi_def):
+        try:
+            with open(self._path(digest, "spec.pickle"), "rb") as f:
+                data = f.read()
+        except IOError:
+            return None
+        try:
+            return loads_spec(data, openapi_def)
+        except Exception:
+            openapi_3_specs_logger.warning("Ignoring unreadable cached spec %s.", digest, exc_info=True)
+            return None
+
+    def store(self, digest, spec):
+        try:
+            data = dumps_spec(spec)
+        except Exception:
+            openapi_3_specs_logger.warning("Unable to cache spec %s.", digest, exc_info=True)
+            return
+        self._write(self._path(digest, "spec.pickle"), data)
+
+
+def build_spec(openapi_def, validate=True, cache_dir=None):
+    """
+    Build (and validate, if asked to) an openapi-core spec, reusing a spec prebuilt in this process or
+    one from the on disk cache in cache_dir when there is one for the exact same specification.
+    """
+    if cache_dir is None and not _PREBUILT_SPECS:
+        return create_spec(openapi_def, validate=validate)
+
+    digest = spec_digest(openapi_def)
+    if digest in _PREBUILT_SPECS:
+        spec, validated = _PREBUILT_SPECS[digest]
+        if validate and not validated:
+            validate_spec(openapi_def)
+            _PREBUILT_SPECS[digest] = (spec, True)
+        return spec
+    if cache_dir is None:
+        return create_spec(openapi_def, validate=validate)
+
+    cache = SpecCache(cache_dir)
+    spec = cache.load(digest, openapi_def)
+    if spec is not None:
+        return spec
+    # The spec is only cached after it's been validated, but it may not have been picklable.
+    already_validated = cache.is_validated(digest)
+    spec = create_spec(openapi_def, validate=validate and not already_validated)
+    if validate and not already_validated:
+        cache.mark_validated(digest)
+    if validate or already_validated:
+        cache.store(digest, spec)
+    return spec
+
+
+def prebuild_spec(openapi_def, validate=True, cache_dir=None):
+    """
+    Build a spec in this process ahead of time so that every OpenAPIPlugin created for the same
+    specification later on reuses it. Calling this in a pre-fork server's master process means that
+    workers share a single copy of the spec instead of each building their own.
+    """
+    spec = build_spec(openapi_def, validate=validate, cache_dir=cache_dir)
+    digest = spec_digest(openapi_def)
+    _PREBUILT_SPECS[digest] = (spec, validate or _PREBUILT_SPECS.get(digest, (None, False))[1])
+    return spec
+
+
+def load_spec_file(path):
+    """
+    Load an OpenAPI specification dictionary from a JSON file, or from a YAML file if PyYAML is installed.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if path.endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError("PyYAML is required to load YAML OpenAPI specifications.")
+        return yaml.safe_load(data)
+    return json.loads(data.decode("utf-8"))
+
+
+class SpecFileWatcher(object):
+    """
+    Polls a specification file for changes on a background thread, calling on_change with its path
+    whenever it does. Errors from on_change are logged, and the file is checked again as usual.
+    """
+
+    def __init__(self, path, on_change, interval=1.0):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self._signature = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def start(self):
+        self._signature = self._stat()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="openapi3-spec-watcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def check(self) -> bool:
+        """
+        Check the file for changes right away, returning whether it had changed.
+        """
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            return False
+        self._signature = signature
+        try:
+            self.on_change(self.path)
+        except Exception:
+            openapi_3_specs_logger.exception("Unable to reload the OpenAPI specification from %s.", self.path)
+        return True
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
@@ -0,0 +1,611 @@
+from openapi_core.casting.schemas.exceptions import CastError
+from openapi_core.casting.schemas.factories import SchemaCastersFactory
+from openapi_core.deserializing.exceptions import DeserializeError
+from openapi_core.deserializing.media_types.factories import MediaTypeDeserializersFactory
+from openapi_core.deserializing.parameters.factories import ParameterDeserializersFactory
+from openapi_core.schema.media_types.exceptions import InvalidContentType
+from openapi_core.schema.request_bodies.exceptions import MissingRequestBody
+from openapi_core.exceptions import OpenAPIError
+from openapi_core.schema.schemas.enums import SchemaType
+from openapi_core.templating.paths.exceptions import PathError
+from openapi_core.templating.paths.finders import PathFinder
+from openapi_core.validation.exceptions import InvalidSecurity
+from openapi_core.validation.request.datatypes import OpenAPIRequest, RequestParameters, RequestValidationResult
+from openapi_core.validation.request.validators import RequestValidator
+from openapi_core.unmarshalling.schemas.enums import UnmarshalContext
+from openapi_core.unmarshalling.schemas.exceptions import InvalidSchemaValue, UnmarshalError, ValidateError
+from openapi_core.unmarshalling.schemas.factories import SchemaUnmarshallersFactory
+from openapi_core.validation.response.validators import ResponseValidator
+from jsonschema.exceptions import ValidationError
+from six import iteritems, itervalues
+from .datatypes import BottleOpenAPIRequest
+from collections import OrderedDict
+import attr
+import codecs
+import json
+import logging
+import re
+import threading
+
+
+openapi_3_validators_logger = logging.getLogger(__name__)
+
+
+def json_loads(value):
+    # The standard library parser accepts UTF-8/16/32 bytes directly, so there's no need to decode
+    # the body into a string first like the openapi-core deserializer does.
+    if isinstance(value, (bytearray, memoryview)):
+        value = bytes(value)
+    return json.loads(value)
+
+
+DEFAULT_MEDIA_TYPE_DESERIALIZERS = {
+    'application/json': json_loads,
+}
+
+MAX_REQUEST_BODY_SIZE_EXTENSION = 'x-max-request-body-size'
+
+_JSON_WHITESPACE_REGEX = re.compile(r'[ \t\n\r]*')
+
+# Characters that can carry on a JSON number that raw_decode stopped short of (e.g. at '1.' or '1e+').
+_JSON_NUMBER_CONTINUATION_REGEX = re.compile(r'[0-9.eE+-]*')
+
+
+def iter_json_array(stream, chunk_size=64 * 1024):
+    """
+    Incrementally parse a JSON document from a binary stream whose top level value is an array,
+    yielding the items one at a time without ever holding the whole document in memory.
+
+    :raises ValueError: If the stream doesn't hold a well formed JSON array.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill(buf, pos):
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return buf[pos:] + text_decoder.decode(b'', final=True), 0, True
+        return buf[pos:] + text_decoder.decode(chunk), 0, False
+
+    def skip_whitespace(buf, pos, eof):
+        while True:
+            pos = _JSON_WHITESPACE_REGEX.match(buf, pos).end()
+            if pos < len(buf) or eof:
+                return buf, pos, eof
+            buf, pos, eof = fill(buf, pos)
+
+    buf, pos, eof = skip_whitespace(buf, pos, eof)
+    if buf[pos:pos + 1] != '[':
+        raise ValueError("Expected a JSON array.")
+    buf, pos, eof = skip_whitespace(buf, pos + 1, eof)
+    if buf[pos:pos + 1] == ']':
+        pos += 1
+    else:
+        while True:
+            while True:
+                try:
+                    item, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if eof:
+                        raise
+                else:
+                    # A value running up to (or stopping just short of) the end of the buffer, like a number
+                    # cut off after its '.' or 'e', may not be complete yet.
+                    if eof or _JSON_NUMBER_CONTINUATION_REGEX.match(buf, end).end() < len(buf):
+                        break
+                buf, pos, eof = fill(buf, pos)
+            pos = end
+            yield item
+            buf, pos, eof = skip_whitespace(buf, pos, eof)
+            separator = buf[pos:pos + 1]
+            if separator == ']':
+                pos += 1
+                break
+            elif separator != ',':
+                raise ValueError("Expected ',' or ']' after a JSON array item.")
+            buf, pos, eof = skip_whitespace(buf, pos + 1, eof)
+    buf, pos, eof = skip_whitespace(buf, pos, eof)
+    if pos != len(buf):
+        raise ValueError("Unexpected data after the JSON array.")
+
+
+def is_streamable_media_type(media_type):
+    """
+    Can request bodies of this media type be validated item by item as they are parsed? Only
+    JSON arrays qualify, and only when none of their constraints need the whole array at once.
+    """
+    schema = media_type.schema
+    return (
+        media_type.mimetype == 'application/json' and
+        schema is not None and
+        schema.type == SchemaType.ARRAY and
+        schema.items is not None and
+        not schema.unique_items and
+        not schema.enum and
+        not schema.all_of and
+        not schema.one_of
+    )
+
+
+@attr.s(hash=True)
+class RequestBodyTooLarge(OpenAPIError):
+    """The request body is larger than the operation allows."""
+    size = attr.ib()
+    max_size = attr.ib()
+
+    def __str__(self):
+        return "Request body of {size} bytes exceeds the maximum size of {max_size} bytes".format(
+            size=self.size, max_size=self.max_size
+        )
+
+
+class IndexedOperation(object):
+    """
+    The result of looking up a single (route rule, method) pair in the spec: either the
+    resolved path item and operation (with their merged parameters, request body and
+    responses), or the path error that looking it up produced.
+    """
+
+    def __init__(self, find_result=None, error=None):
+        self.find_result = find_result
+        self.error = error
+        if find_result is not None:
+            self.path, self.operation, self.server, self.path_result, self.server_result = find_result
+            self.parameters = self._merge_parameters(self.path, self.operation)
+            self.request_body = self.operation.request_body
+            self.responses = self.operation.responses
+            max_body_size = self.operation.extensions.get(MAX_REQUEST_BODY_SIZE_EXTENSION)
+            self.max_request_body_size = int(max_body_size.value) if max_body_size is not None else None
+        else:
+            self.path = self.operation = self.server = self.path_result = self.server_result = None
+            self.parameters = []
+            self.request_body = None
+            self.responses = {}
+            self.max_request_body_size = None
+
+    @staticmethod
+    def _merge_parameters(path, operation):
+        # Operation level parameters override path level parameters with the same name and location.
+        merged = []
+        seen = set()
+        for param_name, param in list(iteritems(operation.parameters)) + list(iteritems(path.parameters)):
+            if (param_name, param.location.value) in seen:
+                continue
+            seen.add((param_name, param.location.value))
+            merged.append((param_name, param))
+        return merged
+
+    def key(self, method, full_url_pattern):
+        """
+        A name for the operation, for reporting: its operationId if it has one, and otherwise its method and path.
+        """
+        if self.operation is not None and self.operation.operation_id is not None:
+            return self.operation.operation_id
+        return "{0} {1}".format(method.upper(), full_url_pattern)
+
+    def find(self):
+        if self.error is not None:
+            # Don't let the traceback of a shared exception instance grow on every raise.
+            raise self.error.with_traceback(None)
+        return self.find_result
+
+
+class OperationIndex(object):
+    """
+    Maps Bottle (route rule, method) pairs directly onto the operations in a spec, so that the
+    spec's paths only get searched once per route instead of once per request.
+    """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, rule, full_url_pattern, method):
+        key = (rule, method)
+        try:
+            return self._entries[key]
+        except KeyError:
+            pass
+        entry = self._entries[key] = self.find(full_url_pattern, method)
+        return entry
+
+    def find(self, full_url_pattern, method):
+        """
+        Look an operation up without adding it to the index.
+        """
+        probe = OpenAPIRequest(
+            full_url_pattern=full_url_pattern,
+            method=method,
+            body=None,
+            mimetype=None
+        )
+        try:
+            return IndexedOperation(find_result=PathFinder(self.spec).find(probe))
+        except PathError as e:
+            return IndexedOperation(error=e)
+
+
+class RequestValidationCache(object):
+    """
+    A bounded LRU cache of request validation results, for operations whose requests are validated
+    on their parameters alone. Results are keyed on the operation and the values of just the parameters
+    the operation declares, so requests that differ only in other headers, cookies or query arguments
+    share an entry.
+
+    Requests are never cached when they have a body, or when their operation (or the spec) has security
+    requirements, since those depend on per request credentials.
+    """
+
+    def __init__(self, spec, maxsize=1024):
+        self.spec = spec
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        # The parameters each operation's results depend on, or None if they can't be cached.
+        self._key_parameters = {}
+
+    def __len__(self):
+        return len(self._results)
+
+    def _get_key_parameters(self, indexed_operation):
+        try:
+            return self._key_parameters[id(indexed_operation)][1]
+        except KeyError:
+            pass
+        if (indexed_operation.error is not None or indexed_operation.request_body is not None or
+                indexed_operation.operation.security or self.spec.security):
+            key_parameters = None
+        else:
+            key_parameters = tuple(
+                (param.location.value, param_name) for param_name, param in indexed_operation.parameters
+            )
+        self._key_parameters[id(indexed_operation)] = (indexed_operation, key_parameters)
+        return key_parameters
+
+    def key(self, request):
+        """
+        The cache key for a request, or None if its validation result can't be cached.
+        """
+        indexed_operation = getattr(request, 'indexed_operation', None)
+        if indexed_operation is None or request.body or getattr(request, 'body_stream', None) is not None:
+            return None
+        key_parameters = self._get_key_parameters(indexed_operation)
+        if key_parameters is None:
+            return None
+        values = []
+        for location_name, param_name in key_parameters:
+            location = request.parameters[location_name]
+            if hasattr(location, 'getall'):
+                values.append(tuple(location.getall(param_name)))
+            else:
+                values.append(location.get(param_name))
+        return id(indexed_operation), tuple(values)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                result = self._results[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._results.move_to_end(key)
+            self.hits += 1
+        return self._copy_result(result)
+
+    def put(self, key, result):
+        # Handlers get the validated parameters, so the cache keeps (and hands out) its own copies.
+        result = self._copy_result(result)
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+
+    @staticmethod
+    def _copy_result(result):
+        return RequestValidationResult(
+            errors=list(result.errors),
+            body=result.body,
+            parameters=RequestParameters(
+                path=dict(result.parameters.path),
+                query=dict(result.parameters.query),
+                header=dict(result.parameters.header),
+                cookie=dict(result.parameters.cookie)
+            ),
+            security=result.security
+        )
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self.hits = self.misses = 0
+
+
+class CachingSchemaUnmarshallersFactory(SchemaUnmarshallersFactory):
+    """
+    Schema unmarshallers factory that builds each unmarshaller (and its JSON schema validator)
+    only once per schema, instead of once per value being unmarshalled.
+    """
+
+    def __init__(self, resolver=None, custom_formatters=None, context=None):
+        super(CachingSchemaUnmarshallersFactory, self).__init__(
+            resolver=resolver, custom_formatters=custom_formatters, context=context
+        )
+        self._format_checker = super(CachingSchemaUnmarshallersFactory, self)._get_format_checker()
+        self._unmarshallers = {}
+
+    def __len__(self):
+        return len(self._unmarshallers)
+
+    def create(self, schema, type_override=None):
+        key = (id(schema), type_override)
+        try:
+            return self._unmarshallers[key][1]
+        except KeyError:
+            pass
+        unmarshaller = super(CachingSchemaUnmarshallersFactory, self).create(schema, type_override=type_override)
+        # Hang on to the schema itself so its id can't be reused while it's a cache key.
+        self._unmarshallers[key] = (schema, unmarshaller)
+        return unmarshaller
+
+    def _get_format_checker(self):
+        return self._format_checker
+
+
+class CachingSchemaCastersFactory(SchemaCastersFactory):
+    """
+    Schema casters factory that builds each caster only once per schema.
+    """
+
+    def __init__(self):
+        self._casters = {}
+
+    def create(self, schema):
+        try:
+            return self._casters[id(schema)][1]
+        except KeyError:
+            pass
+        caster = super(CachingSchemaCastersFactory, self).create(schema)
+        self._casters[id(schema)] = (schema, caster)
+        return caster
+
+
+class _CompiledValidatorMixin(object):
+    """
+    Replaces the per call factory construction in the openapi-core validators with
+    deserializers, casters and unmarshallers that are built once per parameter, media type
+    and schema and then reused. The unmarshallers themselves are the stock openapi-core
+    ones, so validation errors are exactly the same as before.
+    """
+    UNMARSHAL_CONTEXT = None
+
+    def __init__(self, *args, **kwargs):
+        super(_CompiledValidatorMixin, self).__init__(*args, **kwargs)
+        if self.custom_media_type_deserializers is None:
+            self.custom_media_type_deserializers = dict(DEFAULT_MEDIA_TYPE_DESERIALIZERS)
+        self.unmarshallers_factory = CachingSchemaUnmarshallersFactory(
+            self.spec._resolver, self.custom_formatters, context=self.UNMARSHAL_CONTEXT
+        )
+        self.casters_factory = CachingSchemaCastersFactory()
+        self._media_type_deserializers_factory = MediaTypeDeserializersFactory(
+            self.custom_media_type_deserializers
+        )
+        self._media_type_deserializers = {}
+
+    def _compile_media_type(self, media_type):
+        self._get_media_type_deserializer(media_type)
+        self._compile_schema(media_type.schema)
+
+    def _compile_schema(self, schema):
+        if schema is None:
+            return
+        self.casters_factory.create(schema)
+        try:
+            self.unmarshallers_factory.create(schema)
+        except Exception:
+            # Leave it to the request path to report, so errors surface exactly where they used to.
+            openapi_3_validators_logger.debug("Unable to precompile schema %r", schema, exc_info=True)
+
+    def _get_media_type_deserializer(self, media_type):
+        try:
+            return self._media_type_deserializers[id(media_type)][1]
+        except KeyError:
+            pass
+        deserializer = self._media_type_deserializers_factory.create(media_type)
+        self._media_type_deserializers[id(media_type)] = (media_type, deserializer)
+        return deserializer
+
+    def _deserialise_media_type(self, media_type, value):
+        return self._get_media_type_deserializer(media_type)(value)
+
+    def _cast(self, param_or_media_type, value):
+        if not param_or_media_type.schema:
+            return value
+        return self.casters_factory.create(param_or_media_type.schema)(value)
+
+    def _unmarshal(self, param_or_media_type, value, context=None):
+        if not param_or_media_type.schema:
+            return value
+        return self.unmarshallers_factory.create(param_or_media_type.schema)(value)
+
+
+class _IndexedValidatorMixin(object):
+
+    def _find_path(self, request):
+        indexed_operation = getattr(request, 'indexed_operation', None)
+        if indexed_operation is None:
+            return super(_IndexedValidatorMixin, self)._find_path(request)
+        return indexed_operation.find()
+
+
+class IndexedRequestValidator(_IndexedValidatorMixin, _CompiledValidatorMixin, RequestValidator):
+    UNMARSHAL_CONTEXT = UnmarshalContext.REQUEST
+
+    def __init__(self, *args, **kwargs):
+        self.result_cache = kwargs.pop('result_cache', None)
+        super(IndexedRequestValidator, self).__init__(*args, **kwargs)
+        self._parameter_deserializers_factory = ParameterDeserializersFactory()
+        self._parameter_deserializers = {}
+
+    def precompile(self, indexed_operation):
+        """
+        Build everything needed to validate requests for the given operation up front.
+        """
+        if indexed_operation.error is not None:
+            return
+        for _, param in indexed_operation.parameters:
+            self._get_parameter_deserializer(param)
+            self._compile_schema(param.schema)
+        if indexed_operation.request_body is not None:
+            for media_type in itervalues(indexed_operation.request_body.content):
+                self._compile_media_type(media_type)
+
+    def _get_parameter_deserializer(self, param):
+        try:
+            return self._parameter_deserializers[id(param)][1]
+        except KeyError:
+            pass
+        deserializer = self._parameter_deserializers_factory.create(param)
+        self._parameter_deserializers[id(param)] = (param, deserializer)
+        return deserializer
+
+    def _deserialise_parameter(self, param, value):
+        return self._get_parameter_deserializer(param)(value)
+
+    def _get_body(self, request, operation):
+        if operation.request_body is None:
+            return None, []
+
+        try:
+            media_type = operation.request_body[request.mimetype]
+        except InvalidContentType as exc:
+            return None, [exc, ]
+
+        if getattr(request, 'body_stream', None) is not None:
+            return self._get_streamed_body(request, media_type)
+
+        try:
+            raw_body = self._get_body_value(operation.request_body, request)
+        except MissingRequestBody as exc:
+            return None, [exc, ]
+
+        try:
+            deserialised = self._deserialise_media_type(media_type, raw_body)
+        except DeserializeError as exc:
+            return None, [exc, ]
+
+        try:
+            casted = self._cast(media_type, deserialised)
+        except CastError as exc:
+            return None, [exc, ]
+
+        try:
+            body = self._unmarshal(media_type, casted)
+        except (ValidateError, UnmarshalError) as exc:
+            return None, [exc, ]
+
+        if isinstance(request, BottleOpenAPIRequest):
+            request.parsed_body = deserialised
+        return body, []
+
+    def _get_streamed_body(self, request, media_type):
+        """
+        Validate a JSON array body item by item as it is read from the request body stream. Nothing
+        is kept around afterwards, so the validated body is always None.
+        """
+        schema = media_type.schema
+        item_count = 0
+        try:
+            for item in iter_json_array(request.body_stream):
+                try:
+                    casted = self.casters_factory.create(schema.items)(item)
+                except CastError as exc:
+                    return None, [exc, ]
+                try:
+                    self.unmarshallers_factory.create(schema.items)(casted)
+                except (ValidateError, UnmarshalError) as exc:
+                    return None, [exc, ]
+                item_count += 1
+        except ValueError:
+            return None, [DeserializeError('<streamed request body>', media_type.mimetype), ]
+
+        if schema.min_items is not None and item_count < schema.min_items:
+            message = "Array of {0} items is too short, it must have at least {1} items".format(
+                item_count, schema.min_items
+            )
+            return None, [InvalidSchemaValue(
+                '<array of {0} items>'.format(item_count), schema.type,
+                schema_errors=(ValidationError(message, validator='minItems'), )
+            ), ]
+        if schema.max_items is not None and item_count > schema.max_items:
+            message = "Array of {0} items is too long, it must have at most {1} items".format(
+                item_count, schema.max_items
+            )
+            return None, [InvalidSchemaValue(
+                '<array of {0} items>'.format(item_count), schema.type,
+                schema_errors=(ValidationError(message, validator='maxItems'), )
+            ), ]
+        return None, []
+
+    def validate(self, request):
+        indexed_operation = getattr(request, 'indexed_operation', None)
+        if indexed_operation is None:
+            return super(IndexedRequestValidator, self).validate(request)
+
+        cache_key = self.result_cache.key(request) if self.result_cache is not None else None
+        if cache_key is not None:
+            result = self.result_cache.get(cache_key)
+            if result is not None:
+                return result
+
+        result = self._validate_indexed(request, indexed_operation)
+        if cache_key is not None:
+            self.result_cache.put(cache_key, result)
+        return result
+
+    def _validate_indexed(self, request, indexed_operation):
+        try:
+            indexed_operation.find()
+        except PathError as exc:
+            return RequestValidationResult(errors=[exc, ])
+
+        try:
+            security = self._get_security(request, indexed_operation.operation)
+        except InvalidSecurity as exc:
+            return RequestValidationResult(errors=[exc, ])
+
+        request.parameters.path = request.parameters.path or \
+            indexed_operation.path_result.variables
+        params, params_errors = self._get_parameters(request, indexed_operation.parameters)
+
+        body, body_errors = self._get_body(request, indexed_operation.operation)
+
+        errors = params_errors + body_errors
+        return RequestValidationResult(
+            errors=errors,
+            body=body,
+            parameters=params,
+            security=security,
+        )
+
+
+class IndexedResponseValidator(_IndexedValidatorMixin, _CompiledValidatorMixin, ResponseValidator):
+    UNMARSHAL_CONTEXT = UnmarshalContext.RESPONSE
+
+    def precompile(self, indexed_operation):
+        """
+        Build everything needed to validate responses for the given operation up front.
+        """
+        if indexed_operation.error is not None:
+            return
+        for operation_response in itervalues(indexed_operation.responses):
+            for media_type in itervalues(operation_response.content):
+                self._compile_media_type(media_type)
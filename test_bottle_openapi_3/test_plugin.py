@@ -1,5 +1,16 @@
+import copy
+import gc
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+from bottle import Bottle, request, response
 from webtest import TestApp
 
+from bottle_openapi_3 import OpenAPIPlugin, SpecRegistry
+
 
 def test_basic_plugin_functionality(test_app: TestApp):
     resp = test_app.get("/foobar")
@@ -17,4 +28,753 @@ def test_basic_plugin_functionality(test_app: TestApp):
     resp = test_app.post_json("/foobar", params={"test": "test"})
     assert resp.status_code == 201
     assert isinstance(resp.json, object)
-    assert resp.json["one"] == 1.0
\ No newline at end of file
+    assert resp.json["one"] == 1.0
+
+
+def test_route_plans(openapi3_spec):
+    app = Bottle()
+    plugin = OpenAPIPlugin(dict(openapi3_spec, servers=[{"url": "/api"}]))
+    app.install(plugin)
+
+    def outside_handler():
+        return "outside"
+
+    def foobar_handler():
+        return {"foo": "bar"}
+
+    app.route("/outside", callback=outside_handler)
+    app.route("/api/foobar", callback=foobar_handler)
+    app.route("/api/missing", callback=foobar_handler)
+
+    outside, foobar, missing = app.routes[-3:]
+    assert plugin.apply(outside_handler, outside) is outside_handler
+    assert plugin._plan_route(foobar).full_url_pattern == "/api/foobar"
+    assert plugin._plan_route(foobar).operation_plans[1]["GET"].indexed_operation.operation.http_method == "get"
+    assert plugin._plan_route(missing).operation_plans[1]["GET"].indexed_operation.error is not None
+
+    test_app = TestApp(app)
+    assert test_app.get("/outside").text == "outside"
+    assert test_app.get("/api/foobar").json == {"foo": "bar"}
+    assert test_app.get("/api/missing", expect_errors=True).status_code == 404
+
+
+def test_operation_index_skips_path_finding(test_app: TestApp, openapi_plugin, monkeypatch):
+    from openapi_core.templating.paths.finders import PathFinder
+
+    assert len(openapi_plugin.operation_index) == 3
+    test_app.app.route("/foobar", method="PUT", callback=lambda: {})
+    test_app.app.routes[-1].prepare()
+    assert len(openapi_plugin.operation_index) == 4
+
+    def fail_find(self, request):
+        raise AssertionError("Path finding should have been done by the operation index.")
+    monkeypatch.setattr(PathFinder, "find", fail_find)
+
+    assert test_app.get("/foobar").json == {"foo": "bar"}
+    assert test_app.post_json("/foobar", params={"test": "test"}).status_code == 201
+    assert test_app.get("/baz", expect_errors=True).status_code == 400
+    assert test_app.put("/foobar", expect_errors=True).status_code == 405
+
+
+def test_compiled_validators_are_reused(openapi3_spec, monkeypatch):
+    from openapi_core.unmarshalling.schemas.factories import SchemaUnmarshallersFactory
+
+    app = Bottle()
+    app.install(OpenAPIPlugin(openapi3_spec))
+
+    @app.route("/foobar", method="POST")
+    def bad_foobar_post_handler():
+        response.status = 201
+        return {"one": 1.0} if request.json.get("bad") else {"one": 1.0, "two": "2"}
+    test_app = TestApp(app)
+
+    assert test_app.post_json("/foobar", params={"bad": False}).status_code == 201
+
+    def fail_get_validator(self, schema):
+        raise AssertionError("Schema validators should have been compiled already.")
+    monkeypatch.setattr(SchemaUnmarshallersFactory, "get_validator", fail_get_validator)
+
+    assert test_app.post_json("/foobar", params={"bad": False}).status_code == 201
+    resp = test_app.post_json("/foobar", params={"bad": True}, expect_errors=True)
+    assert resp.status_code == 500
+    assert "'two' is a required property" in resp.json["errors"][0]
+    resp = test_app.post_json("/foobar", params=[], expect_errors=True)
+    assert resp.status_code == 400
+
+
+def test_auto_jsonify_validates_encoded_responses(openapi3_spec):
+    from bottle import HTTPResponse
+    from bottle_openapi_3 import fast_json_dumps
+
+    app = Bottle()
+    app.install(OpenAPIPlugin(openapi3_spec, json_encoder=fast_json_dumps))
+
+    @app.route("/foobar")
+    def foobar_handler():
+        if request.query.get("wrapped"):
+            return HTTPResponse({"wrapped": True}, status=200)
+        if request.query.get("bad"):
+            return ["not", "an", "object"]
+        return {}
+    test_app = TestApp(app)
+
+    resp = test_app.get("/foobar")
+    assert resp.json == {}
+    assert resp.content_type == "application/json"
+    assert test_app.get("/foobar", params={"wrapped": 1}).json == {"wrapped": True}
+    assert test_app.get("/foobar", params={"bad": 1}, expect_errors=True).status_code == 500
+
+
+def test_auto_jsonify_validates_encoded_non_json_types(openapi3_spec):
+    openapi3_spec["paths"]["/encoded"] = {
+        "get": {
+            "responses": {
+                "200": {
+                    "description": "Values that JSON encoding changes",
+                    "content": {
+                        "application/json": {
+                            "schema": {
+                                "type": "object",
+                                "properties": {
+                                    "ids": {"type": "array", "items": {"type": "integer"}},
+                                    "m": {"type": "object", "additionalProperties": {"type": "string"}}
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+    app = Bottle()
+    app.install(OpenAPIPlugin(openapi3_spec))
+    app.route("/encoded", callback=lambda: {"ids": (1, 2), "m": {1: "a"}})
+
+    assert TestApp(app).get("/encoded").json == {"ids": [1, 2], "m": {"1": "a"}}
+
+
+def test_request_body_is_parsed_once(openapi3_spec, monkeypatch):
+    import bottle
+    app = Bottle()
+    app.install(OpenAPIPlugin(openapi3_spec))
+    seen = {}
+
+    @app.route("/foobar", method="POST")
+    def foobar_post_handler():
+        seen.update(body=request.openapi_body, json=request.json)
+        response.status = 201
+        return {"one": 1, "two": "2"}
+
+    @app.route("/baz")
+    def baz_handler():
+        seen.update(params=request.openapi_params)
+        return {}
+
+    def fail_json_loads(value):
+        raise AssertionError("The request body should only be parsed during validation.")
+    monkeypatch.setattr(bottle, "json_loads", fail_json_loads)
+    test_app = TestApp(app)
+
+    assert test_app.post_json("/foobar", params={"test": [1, 2]}).status_code == 201
+    assert seen["json"] == {"test": [1, 2]}
+    assert seen["body"] == {"test": [1, 2]}
+
+    assert test_app.get("/baz", params={"qParam": "12"}).status_code == 200
+    assert seen["params"].query == {"qParam": 12}
+
+
+def test_request_body_limits_and_streaming(openapi3_spec):
+    openapi3_spec["paths"]["/items"] = {
+        "post": {
+            "x-max-request-body-size": 200,
+            "requestBody": {
+                "required": True,
+                "content": {
+                    "application/json": {
+                        "schema": {
+                            "type": "array",
+                            "maxItems": 5,
+                            "items": {"$ref": "#/components/schemas/FooObject"}
+                        }
+                    }
+                }
+            },
+            "responses": {"204": {"description": "Stored"}}
+        }
+    }
+    app = Bottle()
+    app.install(OpenAPIPlugin(openapi3_spec, max_request_body_size=50, stream_request_body_threshold=30))
+    seen = {}
+
+    @app.route("/items", method="POST")
+    def items_handler():
+        seen.update(body=request.openapi_body)
+        response.status = 204
+
+    @app.route("/foobar", method="POST")
+    def foobar_post_handler():
+        response.status = 201
+        return {"one": 1, "two": "2"}
+    test_app = TestApp(app)
+
+    item = {"one": 1, "two": "2"}
+    assert test_app.post_json("/items", params=[item]).status_code == 204
+    assert seen["body"] == [item]
+
+    assert test_app.post_json("/items", params=[item] * 5).status_code == 204
+    assert seen["body"] is None
+
+    resp = test_app.post_json("/items", params=[item, {"one": 1}, item], expect_errors=True)
+    assert resp.status_code == 400
+    resp = test_app.post("/items", params='[' + '{"one": 1, "two": "2"},' * 3, expect_errors=True,
+                         content_type="application/json")
+    assert resp.status_code == 400
+    resp = test_app.post_json("/items", params=[item] * 10, expect_errors=True)
+    assert resp.status_code == 413
+    resp = test_app.post_json("/items", params=[item] * 6, expect_errors=True)
+    assert resp.status_code == 400
+    assert "at most 5 items" in resp.json["errors"][0]
+
+    resp = test_app.post_json("/foobar", params={"padding": "x" * 50}, expect_errors=True)
+    assert resp.status_code == 413
+
+
+def test_streamed_arrays_split_inside_numbers():
+    import io
+    from bottle_openapi_3.validators import iter_json_array
+    # Chunks can end just after a number's '.', 'e' or sign, which is a number in its own right so far.
+    documents = [b'[1.5e10, 2]', b'[1.5E-3,2.25,-0.5e+7,10]', b'[ 12345.678 ]', b'[1e5, "x", {"y": [0.5]}]']
+    for chunk_size in range(1, 8):
+        for document in documents:
+            assert list(iter_json_array(io.BytesIO(document), chunk_size=chunk_size)) == json.loads(document)
+        for malformed in (b'[1.]', b'[1e+]', b'[1x]'):
+            with pytest.raises(ValueError):
+                list(iter_json_array(io.BytesIO(malformed), chunk_size=chunk_size))
+
+
+def test_openapi_schema_is_cached(openapi3_spec):
+    openapi3_spec["info"]["description"] = "A large enough spec to be worth compressing. " * 50
+    app = Bottle()
+    plugin = OpenAPIPlugin(openapi3_spec)
+    # basePath isn't valid OpenAPI 3, so it can't be part of the spec until after it's been built.
+    plugin.spec_version.openapi_def = dict(plugin.openapi_def, basePath="/api")
+    app.install(plugin)
+    test_app = TestApp(app)
+
+    resp = test_app.get("/openapi.json", headers={"Accept-Encoding": "identity"})
+    assert resp.json["paths"] == openapi3_spec["paths"]
+    assert resp.json["basePath"] == "/"
+    etag = resp.headers["ETag"]
+
+    mounted = test_app.get("/openapi.json", extra_environ={"SCRIPT_NAME": "/mount"})
+    assert mounted.json["basePath"] == "/mount/"
+    assert plugin.openapi_def["basePath"] == "/api"
+
+    # WebTest transparently decodes compressed responses, so check the representation through its ETag.
+    resp = test_app.get("/openapi.json", headers={"Accept-Encoding": "gzip, deflate"})
+    assert resp.headers["ETag"].endswith('-gzip"')
+    assert resp.headers["Vary"] == "Accept-Encoding"
+    assert resp.json == dict(mounted.json, basePath="/")
+
+    resp = test_app.get("/openapi.json", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.body == b""
+
+
+def test_swagger_ui_is_cached(openapi3_spec, monkeypatch):
+    import bottle_openapi_3
+
+    app = Bottle()
+    app.install(OpenAPIPlugin(openapi3_spec, serve_swagger_ui=True))
+    test_app = TestApp(app)
+
+    resp = test_app.get("/ui/")
+    assert resp.content_type == "text/html"
+    assert '"/openapi.json"' in resp.text
+    assert "swagger-ui-bundle.js?v={0}".format(bottle_openapi_3.SWAGGER_UI_VERSION) in resp.text
+
+    def fail_render(*args, **kwargs):
+        raise AssertionError("The Swagger UI index should only be rendered once.")
+    monkeypatch.setattr(bottle_openapi_3, "_render_index_html", fail_render)
+    assert test_app.get("/ui/").text == resp.text
+    assert test_app.get("/ui/", headers={"If-None-Match": resp.headers["ETag"]}).status_code == 304
+
+    resp = test_app.get("/ui/swagger-ui.css")
+    assert resp.content_type == "text/css"
+    assert "immutable" in resp.headers["Cache-Control"]
+    assert test_app.get("/ui/swagger-ui.css", headers={"If-None-Match": resp.headers["ETag"]}).status_code == 304
+    assert test_app.get("/ui/favicon-16x16.png").content_type == "image/png"
+    # Files whose URLs don't change with the Swagger UI version have to be revalidated.
+    assert test_app.get("/ui/oauth2-redirect.html").headers["Cache-Control"] == "no-cache"
+    assert test_app.get("/ui/index.html").headers["Cache-Control"] == "no-cache"
+    assert test_app.get("/ui/../__init__.py", expect_errors=True).status_code == 404
+    assert test_app.get("/ui/missing.js", expect_errors=True).status_code == 404
+
+
+def test_spec_cache(openapi3_spec, tmp_path, monkeypatch, bottle_app):
+    from openapi_core.schema.specs.factories import SpecFactory
+    from bottle_openapi_3 import specs
+
+    monkeypatch.setattr(specs, "_PREBUILT_SPECS", {})
+    OpenAPIPlugin(openapi3_spec, spec_cache_dir=str(tmp_path))
+    digest = specs.spec_digest(openapi3_spec)
+    assert (tmp_path / "{0}.validated".format(digest)).exists()
+    assert (tmp_path / "{0}.spec.pickle".format(digest)).exists()
+
+    def fail(*args, **kwargs):
+        raise AssertionError("The cached spec should have been used.")
+    monkeypatch.setattr(specs, "validate_spec", fail)
+    monkeypatch.setattr(SpecFactory, "create", fail)
+
+    plugin = OpenAPIPlugin(openapi3_spec, spec_cache_dir=str(tmp_path))
+    schema = plugin.openapi_spec.paths["/foobar"].operations["post"].responses["201"].content["application/json"].schema
+    assert schema.required == ["one", "two"]
+    assert schema.properties["one"].type.value == "number"
+    assert not schema.has_default()
+
+    bottle_app.install(plugin)
+    test_app = TestApp(bottle_app)
+    assert test_app.post_json("/foobar", params={"test": "test"}).status_code == 201
+    assert test_app.get("/baz", expect_errors=True).status_code == 400
+
+
+def test_prebuilt_specs_are_shared(openapi3_spec, monkeypatch):
+    from bottle_openapi_3 import prebuild_spec, specs
+
+    monkeypatch.setattr(specs, "_PREBUILT_SPECS", {})
+    spec = prebuild_spec(openapi3_spec)
+    assert OpenAPIPlugin(openapi3_spec).openapi_spec is spec
+    assert OpenAPIPlugin(dict(openapi3_spec, paths={})).openapi_spec is not spec
+
+
+def test_sampled_and_shadow_response_validation(openapi3_spec):
+    openapi3_spec["paths"]["/foobar"]["post"]["operationId"] = "createFoobar"
+
+    def bad_foobar_post_handler():
+        response.status = 201
+        return {"one": 1}
+
+    app = Bottle()
+    app.install(OpenAPIPlugin(openapi3_spec, response_validation_sample_rates={"createFoobar": 0.0}))
+    app.route("/foobar", method="POST", callback=bad_foobar_post_handler)
+    assert TestApp(app).post_json("/foobar", params={}).status_code == 201
+
+    failures = []
+    app = Bottle()
+    plugin = OpenAPIPlugin(
+        openapi3_spec, shadow_response_validation=True,
+        shadow_response_error_handler=lambda req, resp, result: failures.append((req, resp, result))
+    )
+    app.install(plugin)
+    app.route("/foobar", method="POST", callback=bad_foobar_post_handler)
+    test_app = TestApp(app)
+    assert test_app.post_json("/foobar", params={}).json == {"one": 1}
+    plugin.shadow_validation_pool.join()
+    assert len(failures) == 1
+    openapi_request, openapi_response, result = failures[0]
+    assert openapi_request.full_url_pattern.endswith("/foobar")
+    assert openapi_response.status_code == 201
+    assert result.errors
+    assert plugin.shadow_validation_pool.submitted == 1
+    shadow_threads = list(plugin.shadow_validation_pool._threads)
+    app.uninstall(plugin)
+    assert shadow_threads and not any(thread.is_alive() for thread in shadow_threads)
+
+
+def test_phase_metrics(openapi3_spec):
+    openapi3_spec["paths"]["/foobar"]["get"]["operationId"] = "getFoobar"
+    recorded = []
+    app = Bottle()
+    plugin = OpenAPIPlugin(
+        openapi3_spec, serve_stats=True,
+        metrics_sink=lambda operation, timings, errors: recorded.append((operation, timings, errors))
+    )
+    app.install(plugin)
+    app.route("/foobar", callback=lambda: {"foo": "bar"})
+    app.route("/baz", callback=lambda: {"baz": True})
+    test_app = TestApp(app)
+
+    assert test_app.get("/foobar").status_code == 200
+    assert test_app.get("/baz", expect_errors=True).status_code == 400
+    operation, timings, errors = recorded[0]
+    assert operation == "getFoobar"
+    assert set(timings) == {
+        "request_conversion", "request_validation", "handler", "serialization", "response_validation"
+    }
+    assert errors == []
+    assert recorded[1][0] == "GET /baz"
+    assert set(recorded[1][1]) == {"request_conversion", "request_validation"}
+    assert recorded[1][2] == ["MissingRequiredParameter"]
+
+    resp = test_app.get("/openapi-stats.json")
+    assert resp.headers["Cache-Control"] == "no-store"
+    assert resp.json["getFoobar"]["requests"] == 1
+    assert resp.json["getFoobar"]["phases"]["handler"]["count"] == 1
+    assert resp.json["GET /baz"]["errors"] == {"MissingRequiredParameter": 1}
+    assert "/openapi-stats.json" not in {operation for operation, _, _ in recorded}
+
+
+def test_metrics_of_finished_threads_are_folded():
+    import threading
+    from bottle_openapi_3 import MetricsCollector
+    collector = MetricsCollector()
+
+    def record():
+        collector("getFoobar", {"handler": 0.002}, ["ValidateError"])
+    for _ in range(200):
+        thread = threading.Thread(target=record)
+        thread.start()
+        thread.join()
+    record()
+
+    snapshot = collector.snapshot()
+    assert len(collector._shards) == 1
+    assert snapshot["getFoobar"]["requests"] == 201
+    assert snapshot["getFoobar"]["errors"] == {"ValidateError": 201}
+    assert snapshot["getFoobar"]["phases"]["handler"]["count"] == 201
+    collector.reset()
+    assert collector.snapshot() == {}
+
+
+def test_request_validation_cache(openapi3_spec, monkeypatch):
+    from bottle_openapi_3.validators import IndexedRequestValidator
+
+    app = Bottle()
+    plugin = OpenAPIPlugin(openapi3_spec, request_validation_cache_size=2)
+    app.install(plugin)
+    seen = []
+
+    @app.route("/baz")
+    def baz_handler():
+        seen.append(dict(request.openapi_params.query))
+        request.openapi_params.query["qParam"] = "mutated"
+        return {"baz": True}
+
+    @app.route("/foobar", method="POST")
+    def foobar_post_handler():
+        response.status = 201
+        return {"one": 1, "two": "2"}
+    test_app = TestApp(app)
+    cache = plugin.request_validation_cache
+
+    validations = []
+    original_validate = IndexedRequestValidator._validate_indexed
+
+    def counting_validate(self, openapi_request, indexed_operation):
+        validations.append(openapi_request.full_url_pattern)
+        return original_validate(self, openapi_request, indexed_operation)
+    monkeypatch.setattr(IndexedRequestValidator, "_validate_indexed", counting_validate)
+
+    assert test_app.get("/baz", params={"qParam": 1}).status_code == 200
+    assert test_app.get("/baz", params={"qParam": 1, "other": "x"}, headers={"X-Other": "y"}).status_code == 200
+    assert seen == [{"qParam": 1}, {"qParam": 1}]
+    assert (cache.hits, cache.misses, len(validations)) == (1, 1, 1)
+
+    assert test_app.get("/baz", expect_errors=True).status_code == 400
+    assert test_app.get("/baz", expect_errors=True).status_code == 400
+    assert (cache.hits, cache.misses, len(validations)) == (2, 2, 2)
+
+    assert test_app.get("/baz", params={"qParam": 2}).status_code == 200
+    assert len(cache) == 2
+    assert test_app.get("/baz", params={"qParam": 1}).status_code == 200
+    assert (cache.hits, cache.misses) == (2, 4)
+
+    assert test_app.post_json("/foobar", params={}).status_code == 201
+    assert test_app.post_json("/foobar", params={}).status_code == 201
+    assert (cache.hits, cache.misses) == (2, 4)
+
+
+def test_request_parameters_are_looked_up_lazily(openapi3_spec):
+    openapi3_spec["paths"]["/session"] = {
+        "get": {
+            "parameters": [
+                {"name": "session", "in": "cookie", "required": True, "schema": {"type": "string"}},
+                {"name": "X-Request-Id", "in": "header", "schema": {"type": "integer"}}
+            ],
+            "responses": {"204": {"description": "OK"}}
+        }
+    }
+    app = Bottle()
+    app.install(OpenAPIPlugin(openapi3_spec))
+    seen = {}
+
+    @app.route("/foobar")
+    def foobar_handler():
+        seen.update(environ=dict(request.environ), openapi_request=request.openapi_request)
+        return {"foo": "bar"}
+
+    @app.route("/session")
+    def session_handler():
+        seen.update(params=request.openapi_params)
+        response.status = 204
+    test_app = TestApp(app)
+
+    assert test_app.get("/foobar", headers={"Cookie": "session=abc"}).status_code == 200
+    assert "bottle.request.cookies" not in seen["environ"]
+    assert "bottle.request.query" not in seen["environ"]
+    assert not hasattr(seen["openapi_request"], "__dict__")
+
+    resp = test_app.get("/session", headers={"Cookie": "session=abc; other=1", "x-request-id": "12"})
+    assert resp.status_code == 204
+    assert seen["params"].cookie == {"session": "abc"}
+    assert "X-Request-Id" in seen["params"].header
+    assert test_app.get("/session", expect_errors=True).status_code == 400
+
+
+def test_reload(openapi3_spec, tmp_path):
+    app = Bottle()
+    plugin = OpenAPIPlugin(openapi3_spec)
+    app.install(plugin)
+    new_spec = copy.deepcopy(openapi3_spec)
+    new_spec["paths"]["/baz"]["get"]["parameters"][0]["required"] = False
+    new_spec["paths"]["/foobar"]["get"]["responses"]["200"]["content"]["application/json"]["schema"] = {
+        "type": "array"
+    }
+
+    @app.route("/foobar")
+    def foobar_handler():
+        # Requests that are already under way finish against the spec they started with.
+        if request.query.get("reload"):
+            plugin.reload(new_spec)
+        return {"foo": "bar"}
+    app.route("/baz", callback=lambda: {"baz": True})
+    test_app = TestApp(app)
+
+    assert test_app.get("/baz", expect_errors=True).status_code == 400
+    assert test_app.get("/foobar", params={"reload": 1}).json == {"foo": "bar"}
+    assert test_app.get("/baz").status_code == 200
+    assert test_app.get("/foobar", expect_errors=True).status_code == 500
+    assert test_app.get("/openapi.json").json["paths"]["/baz"]["get"]["parameters"][0]["required"] is False
+
+    with pytest.raises(Exception):
+        plugin.reload({"openapi": "3.0.0", "paths": {"/foobar": {"get": {}}}})
+    assert plugin.openapi_def["paths"] == new_spec["paths"]
+    assert test_app.get("/baz").status_code == 200
+
+    # Plugins that don't serve the schema don't serialize it on reload either.
+    quiet_plugin = OpenAPIPlugin(openapi3_spec, serve_openapi_schema=False)
+    quiet_plugin.reload(new_spec)
+    assert not quiet_plugin.spec_version.openapi_schema_payloads
+
+    spec_file = tmp_path / "openapi.json"
+    spec_file.write_text(json.dumps(new_spec))
+    watcher = plugin.watch_spec_file(str(spec_file), interval=3600)
+    try:
+        assert not watcher.check()
+        spec_file.write_text("{ not json")
+        os.utime(str(spec_file), ns=(1, 1))
+        assert watcher.check()
+        assert test_app.get("/baz").status_code == 200
+        spec_file.write_text(json.dumps(openapi3_spec))
+        assert watcher.check()
+        assert test_app.get("/baz", expect_errors=True).status_code == 400
+        assert test_app.get("/foobar").json == {"foo": "bar"}
+    finally:
+        watcher.stop()
+
+
+def test_large_body_validation_is_offloaded(openapi3_spec):
+    from concurrent.futures import ThreadPoolExecutor
+    import threading
+
+    validated_on = []
+
+    class RecordingExecutor(ThreadPoolExecutor):
+        def submit(self, fn, *args, **kwargs):
+            validated_on.append(type(args[-1]).__name__)
+            return super(RecordingExecutor, self).submit(fn, *args, **kwargs)
+
+    app = Bottle()
+    executor = RecordingExecutor(max_workers=1)
+    app.install(OpenAPIPlugin(openapi3_spec, offload_validation_threshold=100, validation_executor=executor))
+    handler_threads = []
+
+    @app.route("/foobar", method="POST")
+    def foobar_post_handler():
+        handler_threads.append(threading.current_thread())
+        response.status = 201
+        return {"one": 1, "two": "2" * len(request.openapi_body["padding"])}
+    test_app = TestApp(app)
+
+    assert test_app.post_json("/foobar", params={"padding": ""}).status_code == 201
+    assert validated_on == []
+    assert test_app.post_json("/foobar", params={"padding": "x" * 100}).status_code == 201
+    assert validated_on == ["BottleOpenAPIRequest", "BottleOpenAPIResponse"]
+    assert handler_threads == [threading.current_thread()] * 2
+
+    resp = test_app.post("/foobar", params="[" * 200, content_type="application/json", expect_errors=True)
+    assert resp.status_code == 400
+    # Executors that were passed in are left for their owner to shut down.
+    app.close()
+    assert executor.submit(len, "still running").result() == 13
+    executor.shutdown()
+
+    app = Bottle()
+    plugin = OpenAPIPlugin(openapi3_spec, offload_validation_threshold=100)
+    app.install(plugin)
+    app.route("/foobar", method="POST", callback=foobar_post_handler)
+    assert TestApp(app).post_json("/foobar", params={"padding": "x" * 100}).status_code == 201
+    default_executor = plugin.validation_executor
+    app.close()
+    assert plugin.validation_executor is None
+    with pytest.raises(RuntimeError):
+        default_executor.submit(len, "")
+
+
+def test_traffic_replay(openapi3_spec, tmp_path):
+    from bottle_openapi_3.replay import main, replay
+
+    spec_file = tmp_path / "openapi.json"
+    spec_file.write_text(json.dumps(openapi3_spec))
+    traffic = tmp_path / "traffic.jsonl"
+    ok_response = {"status": 200, "headers": {"Content-Type": "application/json"}, "body": '{"baz": true}'}
+    records = [
+        {"request": {"method": "GET", "url": "/baz?qParam=1"}, "response": ok_response},
+        {"request": {"method": "GET", "url": "/baz?qParam=x"}, "response": ok_response},
+        {"request": {"method": "POST", "url": "/foobar", "headers": {"Content-Type": "application/json"},
+                     "body": '{"a": 1}'},
+         "response": {"status": 201, "headers": {"Content-Type": "application/json"}, "body": '{"one": 1}'}},
+        {"request": {"method": "GET", "url": "/missing"}},
+        # Bodies logged as JSON rather than as strings.
+        {"request": {"method": "POST", "url": "/foobar", "headers": {"Content-Type": "application/json"},
+                     "body": {"a": 1}},
+         "response": {"status": 201, "headers": {"Content-Type": "application/json"}, "body": {"one": "1"}}},
+        {"request": {"method": "GET", "url": "/baz?qParam=1", "body": 12}},
+    ]
+    traffic.write_text("\n".join(json.dumps(record) for record in records) + "\nnot json\n")
+
+    report = replay(openapi3_spec, str(traffic), workers=2, batch_size=2)
+    assert report.records == 7
+    assert report.operations["GET /baz"]["records"] == 2
+    assert report.operations["GET /baz"]["request_errors"] == {"CastError": 1}
+    assert report.operations["POST /foobar"]["records"] == 2
+    assert report.operations["POST /foobar"]["request_errors"] == {}
+    assert report.operations["POST /foobar"]["response_errors"] == {"InvalidSchemaValue": 2}
+    assert report.operations["<unmatched>"]["request_errors"] == {"PathNotFound": 1}
+    assert report.operations["<unreadable>"]["records"] == 2
+
+    # Records that fail to validate for any other reason are counted, and the run carries on.
+    from bottle_openapi_3.replay import ReplayValidator, replay_batch
+    from bottle_openapi_3.specs import build_spec
+    validator = ReplayValidator(build_spec(openapi3_spec))
+    validator.request_validator.validate = lambda openapi_request: 1 / 0
+    report = replay_batch([json.dumps(record) for record in records[:2]], validator=validator)
+    assert report.operations["<failed>"]["request_errors"] == {"ZeroDivisionError": 2}
+
+    har = tmp_path / "traffic.har"
+    har.write_text(json.dumps({"log": {"entries": [{
+        "request": {"method": "GET", "url": "http://localhost/baz?qParam=1", "headers": []},
+        "response": {"status": 200, "headers": [{"name": "Content-Type", "value": "application/json"}],
+                     "content": {"mimeType": "application/json", "text": '{"baz": true}'}}
+    }]}}))
+    report_file = tmp_path / "report.json"
+    assert main([str(spec_file), str(har), "--workers", "1", "--json", str(report_file), "--fail-on-errors"]) == 0
+    assert json.loads(report_file.read_text())["operations"]["GET /baz"]["records"] == 1
+    assert main([str(spec_file), str(traffic), "--workers", "1", "--fail-on-errors"]) == 1
+
+
+def test_route_config_overrides(openapi3_spec):
+    app = Bottle()
+    plugin = OpenAPIPlugin(openapi3_spec)
+    app.install(plugin)
+
+    @app.route("/foobar", method="POST", openapi3={"validate_responses": False, "max_body": 20})
+    def foobar_post_handler():
+        response.status = 201
+        return {"one": 1}
+
+    @app.route("/foobar", openapi3={"sample_rate": 0.0, "auto_jsonify": False})
+    def foobar_handler():
+        response.content_type = "application/json"
+        return '{"foo": "bar"}'
+
+    @app.route("/baz", **{"openapi3.validate_requests": False})
+    def baz_handler():
+        return {"baz": request.openapi_params is None}
+    test_app = TestApp(app)
+
+    assert test_app.post_json("/foobar", params={}).json == {"one": 1}
+    assert test_app.post_json("/foobar", params={"padding": "x" * 20}, expect_errors=True).status_code == 413
+    assert test_app.get("/foobar").json == {"foo": "bar"}
+    assert test_app.get("/baz").json == {"baz": True}
+
+    foobar_route, = [route for route in app.routes if route.callback is foobar_handler]
+    plan = plugin._plan_route(foobar_route).operation_plans[1]["GET"]
+    assert (plan.response_validation_sample_rate, plan.auto_jsonify, plan.validate_requests) == (0.0, False, True)
+
+    # Config files only give strings, which are converted when the route is planned.
+    app.config.load_dict({"openapi3": {"sample_rate": "0.5", "max_body": "1024", "validate_requests": "false"}})
+    foobar_route.config.update(app.config)
+    plan = plugin._plan_route(foobar_route)
+    assert (plan.response_validation_sample_rate, plan.max_request_body_size, plan.validate_requests) == \
+        (0.5, 1024, False)
+    foobar_route.config["openapi3.sample_rate"] = "often"
+    with pytest.raises(ValueError, match="openapi3.sample_rate"):
+        plugin.apply(foobar_route.callback, foobar_route)
+
+
+def test_deferred_spec_build(openapi3_spec):
+    # Importing the package shouldn't import openapi-core (or what it depends on) just yet.
+    loaded = subprocess.check_output([
+        sys.executable, "-c",
+        "import json, sys, bottle_openapi_3; print(json.dumps([m for m in sys.modules if m.startswith('openapi')]))"
+    ])
+    assert json.loads(loaded.decode("ascii")) == []
+
+    app = Bottle()
+    plugin = OpenAPIPlugin(openapi3_spec, defer_spec_build=True)
+    app.install(plugin)
+    app.route("/foobar", callback=lambda: {"foo": "bar"})
+    app.route("/baz", callback=lambda: {"baz": True})
+    assert not plugin.spec_built
+    assert plugin.openapi_def is openapi3_spec
+    assert plugin.openapi_base_path == "/"
+
+    test_app = TestApp(app)
+    assert test_app.get("/foobar").json == {"foo": "bar"}
+    assert plugin.spec_built
+    assert test_app.get("/baz", expect_errors=True).status_code == 400
+
+    app = Bottle()
+    plugin = OpenAPIPlugin(openapi3_spec, defer_spec_build=True)
+    app.install(plugin)
+    app.route("/foobar", callback=lambda: {"foo": "bar"})
+    plugin.warmup()
+    assert plugin.spec_built
+    assert len(plugin._route_plans) == 1
+    assert TestApp(app).get("/foobar").json == {"foo": "bar"}
+
+
+def test_spec_registry(openapi3_spec):
+    registry = SpecRegistry()
+    other_spec = copy.deepcopy(openapi3_spec)
+    other_spec["info"]["title"] = "Another API"
+
+    first = OpenAPIPlugin(copy.deepcopy(openapi3_spec), spec_registry=registry)
+    second = OpenAPIPlugin(copy.deepcopy(openapi3_spec), spec_registry=registry)
+    other = OpenAPIPlugin(other_spec, spec_registry=registry)
+    uncached = OpenAPIPlugin(copy.deepcopy(openapi3_spec), spec_registry=registry, request_validation_cache_size=8)
+    assert first.spec_version is second.spec_version
+    assert first.request_validator is second.request_validator
+    assert other.spec_version is not first.spec_version
+    assert uncached.spec_version is not first.spec_version
+    shared_schemas = first.openapi_def["components"]["schemas"]
+    assert other.openapi_def["components"]["schemas"]["FooObject"] is shared_schemas["FooObject"]
+    assert other_spec["components"]["schemas"] is not other.openapi_def["components"]["schemas"]
+    assert len(registry) == 3
+
+    app = Bottle()
+    app.install(second)
+    app.route("/foobar", callback=lambda: {"foo": "bar"})
+    assert TestApp(app).get("/foobar").json == {"foo": "bar"}
+
+    usage = registry.memory_usage()
+    assert usage["shared_components"]["count"] == len(openapi3_spec["components"]["schemas"])
+    by_title = {spec["title"]: spec for spec in usage["specs"]}
+    assert by_title["Another API"]["bytes"] > 0
+    assert max(spec["indexed_operations"] for spec in usage["specs"]) == 1
+
+    # Specs are dropped from the registry once no plugin is using them.
+    del other, uncached
+    gc.collect()
+    assert len(registry) == 1